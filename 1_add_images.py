@@ -5,33 +5,24 @@ Created on Fri Apr 29 14:18:54 2022
 
 @author: fred
 """
-from pathlib import Path
-from astropy.io import fits
+from database import ImageBase, minimaldbfields, minimaldbindexes
+from config import datadir, dbname, ingestthreads, calibdir, outdir, \
+                   workdir, utcoffset, tracedir
+from module_trace import startTracing
+from module_ingest import ingest
 
-from database import ImageBase, minimaldbfields
-from config import datadir, dbname
+# (spans of this run, see module_trace.py, if tracedir is set)
+startTracing(tracedir, '1_add_images')
 
-datadir = Path(datadir)
 db = ImageBase(dbname)
-db.create(minimaldbfields)
+db.create(minimaldbfields, indexes=minimaldbindexes)
+db.setUnique('path')
 
-def addImage(imagepath):
-    hdr = fits.getheader(imagepath)
-    db.insert({'path':imagepath,
-               'imagetyp':hdr['imagetyp'],
-               'exptime':hdr['exptime'],
-               'binning':hdr['xbinning'],
-               'airmass':hdr['airmass'],
-               'object':hdr['object'],
-               'focpos':hdr['focpos'],
-               'filter':hdr['filter'],
-               'dateobs':hdr['date-obs'],
-               'ccdtemp':hdr['ccd-temp']})
-
-files = datadir.rglob('*.fits')
-
-for file in files:
-    try:
-        addImage(file)
-    except Exception as e:
-        print(f"Problem with image {file}: {e}")
+# our own products can live inside datadir, do not ingest them:
+nscanned, nnew, nchanged, dt = ingest(db, datadir, 
+                                      [calibdir, outdir, workdir],
+                                      threads=ingestthreads, 
+                                      utcoffset=utcoffset)
+print(f"Scanned {nscanned} files, added {nnew} and updated "
+      f"{nchanged} images in {dt:.1f} s "
+      f"({(nnew + nchanged)/max(dt, 1e-6):.1f} frames/s)")
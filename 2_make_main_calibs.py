@@ -6,219 +6,74 @@ Created on Thu Apr 28 20:18:54 2022
 @author: fred
 """
 
+import multiprocessing
 from pathlib import Path
-import numpy as np
-from ccdproc import CCDData, ImageFileCollection, Combiner, subtract_bias,\
-                    subtract_dark
 from astropy.time import Time
-from astropy.units import s
 
 
-from database import ImageBase
-from config import  dbname, calibdir, flat, bias, dark, workdir
-from module_remove_stars_flats import removeStarsFromArray
+from database import ImageBase, mainbiasfields, mainbiasindexes, \
+                     maindarksfields, maindarksindexes, \
+                     mainflatsfields, mainflatsindexes
+from config import  dbname, calibdir, flat, bias, dark, workdir, combiner, \
+                    combinememory, maxcores, flatstarremoval, moffatfitter, \
+                    cacheproducts, reductionvariance, \
+                    intermediatecompression, tracedir
+from module_trace import startTracing
+from module_calibration_matching import CalibrationMatcher
+from module_taskgraph import TaskGraph
+from module_pipeline import planCalibrations, recordCalibrations
+from module_cache import ProductCache
+
+# (spans of this run, see module_trace.py, if tracedir is set)
+startTracing(tracedir, '2_make_main_calibs')
 
 calibdir = Path(calibdir)
 workdir = Path(workdir)
 
 db = ImageBase(dbname)
 
-db.create(['date:str', 'filter:str', 'binning:int', 'path:str'], 
-          tablename='mainflats')
-db.create(['date:str', 'binning:int', 'path:str'], 
-          tablename='mainbias')
-db.create(['date:str', 'binning:int', 'exptime:float', 'path:str'], 
-          tablename='maindarks')
-
-#################################### biases ###################################
-allbinnings = db.select(['imagetyp'], 
-                        [bias], 
-                        filter=['binning'])
-allbinnings = list(set(allbinnings))
-for binning in allbinnings:
-    relevantentries = db.select(['binning', 'imagetyp'], 
-                                [binning, bias], 
-                                returnType='dict')
-    alldates = [e['dateobs'] for e in relevantentries]
-    alldates = list(Time(alldates, format='isot', scale='utc').to_value('mjd'))
-    alldatesrounded = [round(e) for e in alldates]
-    alldatesrounded = list(set(alldatesrounded))
-    alldates = np.array(alldates)
-    for date in alldatesrounded:
-        relevant = list(np.where((alldates-date <1)*
-                                 (date-alldates < 0.5)))[0]
-        
-        relevantfiles = [relevantentries[i]['path'] for i in relevant]
-        if len(relevantfiles) == 0:
-            break
-        mainbiascmb = ImageFileCollection(filenames=relevantfiles)
-        cmb = Combiner(mainbiascmb.ccds(ccd_kwargs={'unit':'adu'}))
-        cmb.sigma_clipping(low_thresh=2, high_thresh=4, func=np.ma.median)
-        av = cmb.average_combine()
-        date = Time(date, format='mjd').to_value('isot')
-        path = calibdir / f"mainbias_mjd{date}_binning{binning}.fits"
-        av.write(path, overwrite=True)
-        mainbiases = db.select(['recno'], ['*'], filter=['path'], 
-                               tablename='mainbias')
-        if not path in mainbiases:
-            db.insert({'date':date, 'binning':binning, 'path':path},
-                       tablename='mainbias')
+db.create(mainflatsfields, tablename='mainflats', indexes=mainflatsindexes)
+db.create(mainbiasfields, tablename='mainbias', indexes=mainbiasindexes)
+db.create(maindarksfields, tablename='maindarks', indexes=maindarksindexes)
 
+# main calibrations made before we stored their mjd:
+for table in ['mainbias', 'maindarks', 'mainflats']:
+    missing = db.execute(f"select recno, date from {table} where mjd is null")
+    if len(missing) > 0:
+        mjds = Time([date for _, date in missing]).to_value('mjd')
+        db.updateBatch(['recno'], [[recno] for recno, _ in missing],
+                       [{'mjd':float(mjd)} for mjd in mjds], tablename=table)
 
-#################################### darks ####################################
-allbinnings = db.select(['imagetyp'], 
-                        [dark], 
-                        filter=['binning'])
-allbinnings = list(set(allbinnings))
-for binning in allbinnings:
-    allexptimes = db.select(['binning', 'imagetyp'], 
-                            [binning, dark], 
-                            filter=['exptime'])
-    allexptimes = list(set(allexptimes))
-    for exptime in allexptimes:
-        relevantentries = db.select(['binning', 'imagetyp', 'exptime'], 
-                                    [binning, dark, exptime], 
-                                    returnType='dict')
-        if len(relevantentries) == 0:
-            break
-        # for each date, select the closest main bias and subtract it:
-        mainbiases =  db.select(['binning'], 
-                                [3], 
-                                tablename='mainbias',
-                                returnType='dict')
-        mainbiasdates = np.array([Time(e['date']).to_value('mjd') 
-                                        for e in mainbiases])
-        
-        for entry in relevantentries:
-            entrydate = Time(entry['dateobs']).to_value('mjd')
-            closesti = np.argmin(np.abs(mainbiasdates-entrydate))
-            biasccd = CCDData.read(mainbiases[closesti]['path'], unit='adu')
-            darkccd = CCDData.read(entry['path'], unit='adu')
-            reddark = subtract_bias(darkccd, biasccd)
-            filename = Path(entry['path']).name 
-            
-            writepath = workdir / filename.replace('.fits', '_red.fits')
-            reddark.write(writepath, overwrite=True)
-            db.update(['recno'], [entry['recno']], {'reducedpath':writepath})
-            # ah, and update it in our entry as well so that we do not
-            # need to query the database again:
-            entry['reducedpath'] = writepath
+# what is still up to date from the previous runs is not made again:
+cache = ProductCache(db, enabled=cacheproducts)
 
-        alldates = [e['dateobs'] for e in relevantentries]
-        alldates = list(Time(alldates, format='isot', scale='utc').to_value('mjd'))
-        
+# closest main calibrations in time. The ones we are about to make are
+# added as "planned" as we go, so darks find the biases of this run, etc.
+matcher = CalibrationMatcher(db)
 
-            
-        alldatesrounded = [round(e) for e in alldates]
-        alldatesrounded = list(set(alldatesrounded))
-        
-        alldates = np.array(alldates)
-        for date in alldatesrounded:
-            relevant = list(np.where((alldates-date <1)*
-                                     (date-alldates < 0.5)))[0]
-            if len(relevant) == 0:
-                break
-            # now we have all the dates with darks with this exptime and binning.
-            
-            relevantfiles = [relevantentries[i]['reducedpath'] for i in relevant]
-            maindarkcmb = ImageFileCollection(filenames=relevantfiles)
-            cmb = Combiner(maindarkcmb.ccds(ccd_kwargs={'unit':'adu'}))
-            cmb.sigma_clipping(low_thresh=2, high_thresh=4, func=np.ma.median)
-            av = cmb.average_combine()
-            date = Time(date, format='mjd').to_value('isot')
-            path = calibdir / f"maindark_date{date}_binning{binning}_exptime{exptime}.fits"
-            av.write(path, overwrite=True)
-            maindarks = db.select(['recno'], ['*'], filter=['path'], tablename='maindarks')
-            if not path in maindarks:
-                db.insert({'date':date, 'binning':binning, 'path':path,
-                           'exptime':exptime},
-                           tablename='maindarks')
+# We do not make anything here: we build a graph of tasks (combinations, 
+# reductions of single darks and flats), each depending on the 
+# calibrations it needs, and run it on a pool at the end. E.g. the biases
+# are all made in parallel, and a dark is reduced as soon as its bias exists.
+tasks = TaskGraph()
+# several combinations run at the same time, share the memory budget:
+taskmemory = combinememory / maxcores
+reduced, products = planCalibrations(db, tasks, matcher, calibdir, workdir,
+                                     bias, dark, flat, combiner, taskmemory,
+                                     flatstarremoval, moffatfitter, cache,
+                                     reductionvariance,
+                                     intermediatecompression)
 
-#################################### flats ####################################
-allbinnings = db.select(['imagetyp'], 
-                        [flat], 
-                        filter=['binning'])
-allbinnings = list(set(allbinnings))
-for binning in allbinnings:
-    allfilters = db.select(['binning', 'imagetyp'], 
-                            [binning, flat], 
-                            filter=['filter'])
-    allfilters = list(set(allfilters))
-    for filter in allfilters:
-        relevantentries = db.select(['binning', 'imagetyp', 'filter'], 
-                                    [binning, flat, filter], 
-                                    returnType='dict')
-        if len(relevantentries) == 0:
-            break
-        # for each date, select the closest main bias and dark and subtract them:
-        mainbiases =  db.select(['binning'], 
-                                [3], 
-                                tablename='mainbias',
-                                returnType='dict')
-        mainbiasdates = np.array([Time(e['date']).to_value('mjd') 
-                                        for e in mainbiases])
-        maindarks     =  db.select(['binning'], 
-                                   [3], 
-                                   tablename='maindarks',
-                                   returnType='dict')
-        maindarksdates = np.array([Time(e['date']).to_value('mjd') 
-                                        for e in maindarks])
-        
-        for entry in relevantentries:
-            entrydate = Time(entry['dateobs']).to_value('mjd')
-            
-            closesti = np.argmin(np.abs(mainbiasdates-entrydate))
-            biasccd = CCDData.read(mainbiases[closesti]['path'], unit='adu')
-            
-            closestdarki = np.argmin(np.abs(maindarksdates-entrydate))
-            darkccd = CCDData.read(maindarks[closestdarki]['path'], unit='adu')
-            
-            flatccd = CCDData.read(entry['path'], unit='adu')
-            redflat1 = subtract_bias(flatccd, biasccd)
-            redflat = subtract_dark(redflat1, darkccd, 
-                                    dark_exposure=maindarks[closestdarki]['exptime']*s,
-                                    data_exposure=entry['exptime']*s)
-        
-            # remove potential stars from the flat:
-            redflat.data = removeStarsFromArray(redflat.data)
-            filename = Path(entry['path']).name 
-            writepath = workdir / filename.replace('.fits', '_red.fits')
-            
-            redflat.write(writepath, overwrite=True)
-            db.update(['recno'], [entry['recno']], {'reducedpath':writepath})
-            # ah, and update it in our entry as well so that we do not
-            # need to query the database again:
-            entry['reducedpath'] = writepath
-            
-        # now we combine the flats
-        alldates = [e['dateobs'] for e in relevantentries]
-        alldates = list(Time(alldates, format='isot', scale='utc').to_value('mjd'))
-        
+################################### let's go ##################################
+print(f"{len(tasks.tasks)} tasks to run.")
+pool = multiprocessing.Pool(processes=maxcores)
+with cache:
+    # (every task returns the path of its product)
+    tasks.run(pool, ondone=lambda name, path: cache.done(path))
+pool.close()
+print(cache.report())
 
-            
-        alldatesrounded = [round(e) for e in alldates]
-        alldatesrounded = list(set(alldatesrounded))
-        
-        alldates = np.array(alldates)
-        for date in alldatesrounded:
-            relevant = list(np.where((alldates-date <1)*
-                                     (date-alldates < 0.5)))[0]
-            if len(relevant) == 0:
-                break
-            # now we have all the dates with darks with this exptime and binning.
-            relevantfiles = [relevantentries[i]['reducedpath'] for i in relevant]
-            mainflatcmb = ImageFileCollection(filenames=relevantfiles)
-            cmb = Combiner(mainflatcmb.ccds(ccd_kwargs={'unit':'adu'}))
-            cmb.sigma_clipping(low_thresh=2, high_thresh=4, func=np.ma.median)
-            av = cmb.average_combine()
-            date = Time(date, format='mjd').to_value('isot')
-            safefilter = filter.replace(' ', '').replace('/', '')
-            path = calibdir / f"mainflat_date{date}_binning{binning}_filter{safefilter}.fits"
-            av.write(path, overwrite=True)
-            mainflats = db.select(['recno'], ['*'], filter=['path'], tablename='mainflats')
-            if not path in mainflats:
-                db.insert({'date':date, 'binning':binning, 'path':path,
-                           'filter':filter},
-                           tablename='mainflats')
+# and the database, in one go per table:
+recordCalibrations(db, reduced, products)
 
 print("Done with preparing main calibrations")
@@ -9,80 +9,158 @@ Created on Fri Apr 29 16:51:35 2022
 
 import multiprocessing
 from pathlib import Path
-import numpy as np
-from ccdproc import CCDData, subtract_bias,\
-                    subtract_dark, flat_correct
-from astropy.time import Time
-from astropy.units import s
 from astropy.io import fits
 
 
-from database import ImageBase
-from config import  dbname, workdir, target, maxcores
+from database import ImageBase, BatchWriter
+from module_calibration_matching import CalibrationMatcher
+from module_shared_frames import SharedFrames
+from module_cache import ProductCache
+from module_pipeline import reducedPath
+from module_stack import markForRebuild
+from module_reduction import darkScale, calibrationTerms, reduceRows, \
+                             reduceCCDProc, checkAgainstCCDProc
+from module_fitsio import FitsFrame, readFrame, writeFrame
+from config import  dbname, workdir, target, maxcores, dbwal, dbbatchsize, \
+                    reductionengine, scaledark, reductionvariance, \
+                    checkreduction, cacheproducts, intermediatecompression, \
+                    tracedir
+from module_trace import startTracing, span, readSpan
+
+# (spans of this run, see module_trace.py, if tracedir is set)
+startTracing(tracedir, '3_reduce_images')
 
 workdir = Path(workdir)
 
-db = ImageBase(dbname)
+db = ImageBase(dbname, wal=dbwal)
 
 
 allimages  = db.select(['object'], 
                        [target],
                        returnType='dict')
 
-
+# the closest main calibrations of every image, found once here in the parent
+# (binary searches in the sorted mjds of each calibration table):
+matcher = CalibrationMatcher(db)
+for image in allimages:
+    image['mainbias'] = matcher.closest('mainbias', image['mjd'], 
+                                        binning=image['binning'])
+    image['maindark'] = matcher.closest('maindarks', image['mjd'], 
+                                        binning=image['binning'])
+    image['mainflat'] = matcher.closest('mainflats', image['mjd'], 
+                                        binning=image['binning'], 
+                                        filter=image['filter'])
+
+# the frames reduced by a previous run, from the same raw frame and 
+# calibrations with the same parameters, are left alone:
+cache = ProductCache(db, enabled=cacheproducts)
+for image in allimages:
+    image['writepath'] = reducedPath(workdir, image)
+allimages = [image for image in allimages 
+               if not cache.check(image['writepath'], 'reduce', 
+                                  [image['path'], image['mainbias']['path'],
+                                   image['maindark']['path'], 
+                                   image['mainflat']['path']],
+                                  engine=reductionengine, scaledark=scaledark,
+                                  variance=reductionvariance,
+                                  compression=intermediatecompression)]
+print(cache.report())
+# the incremental stacks with an old version of these frames are rebuilt:
+markForRebuild(db, allimages)
+
+def calibKey(image):
+    # the calibration terms depend on the three calibrations, and on
+    # the exposure time only if the dark is scaled:
+    darkscale = darkScale(image['maindark']['exptime'], image['exptime'], 
+                          scaledark)
+    return (f"{image['mainbias']['path']}|{image['maindark']['path']}|"
+            f"{image['mainflat']['path']}|{darkscale}")
+
+# and each of those calibrations is read once, into shared memory. 
+# With the fast engine, we directly share the combined terms 
+# (bias + dark, normalised flat) of each combination of calibrations:
+calibs = SharedFrames()
+for image in allimages:
+    if reductionengine == 'ccdproc':
+        for calib in ['mainbias', 'maindark', 'mainflat']:
+            calibs.load(image[calib]['path'])
+        continue
+    key = calibKey(image)
+    if key in calibs.frames:
+        continue
+    bias, biasvar = readFrame(image['mainbias']['path'], reductionvariance)
+    dark, darkvar = readFrame(image['maindark']['path'], reductionvariance)
+    flat, flatvar = readFrame(image['mainflat']['path'], reductionvariance)
+    darkscale = darkScale(image['maindark']['exptime'], image['exptime'], 
+                          scaledark)
+    terms = calibrationTerms(bias, dark, flat, darkscale, 
+                             biasvar, darkvar, flatvar)
+    for name, term in zip(['offset', 'invflat', 'offsetvar', 'flatrelvar'],
+                          terms):
+        calibs.add(f"{key}|{name}", term)
+
+if checkreduction and reductionengine != 'ccdproc' and len(allimages) > 0:
+    # the fast engine should give the same as the ccdproc chain:
+    image = allimages[0]
+    difference = checkAgainstCCDProc(fits.getdata(image['path']),
+                                     fits.getdata(image['mainbias']['path']),
+                                     fits.getdata(image['maindark']['path']),
+                                     fits.getdata(image['mainflat']['path']),
+                                     image['maindark']['exptime'],
+                                     image['exptime'],
+                                     scaledark=scaledark)
+    print(f"fast reduction vs ccdproc: max relative difference {difference:.1e}")
+
+
+
+def reduceOne(image):
+    variance = None
+    if reductionengine == 'ccdproc':
+        with readSpan(image['path']):
+            raw = fits.getdata(image['path'])
+        with span('ccdproc'):
+            redimg = reduceCCDProc(raw, 
+                                   calibs.get(image['mainbias']['path']),
+                                   calibs.get(image['maindark']['path']),
+                                   calibs.get(image['mainflat']['path']),
+                                   image['maindark']['exptime'],
+                                   image['exptime'],
+                                   scaledark=scaledark)
+    else:
+        key = calibKey(image)
+        offset = calibs.get(f"{key}|offset")
+        invflat = calibs.get(f"{key}|invflat")
+        # (the raw frame is read band by band, as it is reduced)
+        with readSpan(image['path']), span('reduce'), \
+             FitsFrame(image['path']) as raw:
+            if reductionvariance and f"{key}|offsetvar" in calibs.frames:
+                redimg, variance = reduceRows(raw, offset, invflat, 
+                                              calibs.get(f"{key}|offsetvar"),
+                                              calibs.get(f"{key}|flatrelvar"))
+            else:
+                redimg = reduceRows(raw, offset, invflat)
+    
+    with span('write', path=image['writepath']):
+        writeFrame(image['writepath'], redimg, variance,
+                   compression=intermediatecompression)
 
 
 def reduce(image):
-    mainbiases =  db.select(['binning'], 
-                            [image['binning']], 
-                            tablename='mainbias',
-                            returnType='dict')
-    mainbiasdates = np.array([Time(e['date']).to_value('mjd') 
-                                    for e in mainbiases])
-    maindarks     =  db.select(['binning'], 
-                               [image['binning']],
-                               tablename='maindarks',
-                               returnType='dict')
-    maindarksdates = np.array([Time(e['date']).to_value('mjd') 
-                                    for e in maindarks])
-    mainflats      =  db.select(['binning', 'filter'], 
-                                [image['binning'], image['filter']], 
-                                tablename='mainflats',
-                                returnType='dict')
-    mainflatsdates = np.array([Time(e['date']).to_value('mjd') 
-                                    for e in mainflats])
-    imagedate = Time(image['dateobs']).to_value('mjd')
-    
-    closesti = np.argmin(np.abs(mainbiasdates-imagedate))
-    biasccd = CCDData.read(mainbiases[closesti]['path'], unit='adu')
-
-    
-    closestdarki = np.argmin(np.abs(maindarksdates-imagedate))
-    darkccd = CCDData.read(maindarks[closestdarki]['path'], unit='adu')
-    
-    closestflati = np.argmin(np.abs(mainflatsdates-imagedate))
-    flatccd = CCDData.read(mainflats[closestflati]['path'], unit='adu')
-    
-    imgccd = CCDData.read(image['path'], unit='adu')
-    redimg1 = subtract_bias(imgccd, biasccd)
-    redimg2 = subtract_dark(redimg1, darkccd, 
-                            dark_exposure=maindarks[closestdarki]['exptime']*s,
-                            data_exposure=image['exptime']*s)
-    redimg = flat_correct(redimg2, flatccd)
-    redimg.data = redimg.data.astype(np.float32)
-    redimg.uncertainty.array = redimg.uncertainty.array.astype(np.float32)
-    
-    filename = Path(image['path']).name 
-    writepath = workdir / filename.replace('.fits', '_red.fits')
-    fits.writeto(writepath, redimg.data, overwrite=True)
-    db.update(['recno'], [image['recno']], {'reducedpath':writepath})
-    # ah, and update it in our entry as well so that we do not
-    # need to query the database again:
-    image['reducedpath'] = writepath
+    with span('frame', recno=image['recno']):
+        reduceOne(image)
+    # the database is updated by the writer in the parent process:
+    return image['recno'], image['writepath']
 
 
 pool = multiprocessing.Pool(processes=maxcores)
-pool.map(reduce, allimages)
+# one writer commits the results as they come, in batches:
+with calibs, cache, BatchWriter(db, batchsize=dbbatchsize) as writer:
+    for recno, path in pool.imap_unordered(reduce, allimages):
+        # a new reduced frame: its sources must be found again, and it
+        # goes into the stacks again.
+        writer.put([recno], {'reducedpath':path, 'sources':None,
+                             'stacked':0})
+        cache.done(path)
 
 
 
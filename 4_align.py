@@ -7,18 +7,29 @@ Created on Fri Apr 29 18:23:34 2022
 """
 
 import multiprocessing
-import astroalign as aa
 from pathlib import Path
-import numpy as np
-from astropy.io import fits
 
 
-from database import ImageBase
-from config import  dbname, workdir, target, maxcores, crop
+from database import ImageBase, BatchWriter
+from config import  dbname, workdir, target, maxcores, crop, \
+                    dbwal, dbbatchsize, writealigned, alignengine, \
+                    stackmode, outdir, cacheproducts, \
+                    intermediatecompression, tracedir
+from module_trace import startTracing, span
+from module_alignment import detectSources, sourcesToJSON, sourcesFromJSON, \
+                             chooseReference, referencesFor, alignFrame, \
+                             alignmentProduct, alignmentExists
+from module_stack import StreamingStacker, stackPath, writeStack, \
+                         markForRebuild
+from module_cache import ProductCache
+from module_fitsio import FitsFrame
+
+# (spans of this run, see module_trace.py, if tracedir is set)
+startTracing(tracedir, '4_align')
 
 workdir = Path(workdir)
 
-db = ImageBase(dbname)
+db = ImageBase(dbname, wal=dbwal)
 
 
 
@@ -26,23 +37,82 @@ allimages  = db.select(['object'],
                        [target],
                        returnType='dict')
 
-refimg = allimages[len(allimages)//2]
-refimgarray = fits.getdata(refimg['reducedpath'])[crop:-crop, crop:-crop]
+# we keep the reference of the previous runs if it is still there: the
+# persisted stacks are on its grid.
+refimg = chooseReference(allimages)
+# the sources, asterisms and invariants of the reference (and its spectra
+# for the frames that are only shifted), once for all the frames. The 
+# workers inherit them:
+refpoints = sourcesFromJSON(refimg['sources'], crop)
+if refpoints is None:
+    with FitsFrame(refimg['reducedpath']) as frame:
+        refpoints = detectSources(frame.cropped(crop), crop=crop)
+    refimg['sources'] = sourcesToJSON(refpoints, crop)
+    db.update(['recno'], [refimg['recno']], {'sources':refimg['sources']})
+referencesFor(refimg['reducedpath'], refpoints, crop, alignengine)
+
+# the frames already aligned on this reference, with the same parameters, 
+# and not reduced again since, are left alone:
+cache = ProductCache(db, enabled=cacheproducts)
+for image in allimages:
+    image['outname'] = None
+    if writealigned:
+        outname = Path(image['reducedpath']).name
+        image['outname'] = workdir / outname.replace('.fits', '_aligned.fits')
+uptodate, todo = [], []
+for image in allimages:
+    if cache.check(alignmentProduct(image['reducedpath']), 'align',
+                   [image['reducedpath'], refimg['reducedpath']],
+                   alignmentExists(image, image['outname']),
+                   crop=crop, engine=alignengine,
+                   compression=intermediatecompression):
+        uptodate.append(image)
+    else:
+        todo.append(image)
+print(cache.report())
+# the incremental stacks with an old alignment of these frames are rebuilt:
+markForRebuild(db, todo)
 
 def alignOneImage(image):
-    path = image['reducedpath']
-    array = fits.getdata(path)[crop:-crop, crop:-crop]
-    
-    aligned = aa.register(array.astype(np.float64), 
-                          refimgarray.astype(np.float64))
-    
-    
-    outname = Path(path).name
-    outname = workdir / outname.replace('.fits', '_aligned.fits')
-    fits.writeto(outname, aligned[0].astype(np.float32), overwrite=1)
-    db.update(['recno'], [image['recno']], {'alignedpath':outname})
-
-# for image in allimages:
-    # alignOneImage(image)
+    # we only keep the transform, the stacking applies it.
+    with span('frame', recno=image['recno']):
+        alignment, newsources, engine = alignFrame(image['reducedpath'], 
+                                                   image['sources'],
+                                                   refimg['reducedpath'], 
+                                                   refimg['sources'],
+                                                   refimg['recno'], crop, 
+                                                   alignengine, 
+                                                   image['outname'],
+                                                   intermediatecompression)
+    # the database is updated by the writer in the parent process:
+    return image['recno'], image['outname'], newsources, alignment, engine
+
 pool = multiprocessing.Pool(processes=maxcores)
-pool.map(alignOneImage, allimages)
\ No newline at end of file
+# one writer commits the results as they come, in batches:
+engines = {'fft':0, 'astroalign':0}
+images = {image['recno']:image for image in allimages}
+# streaming stacks: each frame goes into the sums of its filter as soon as
+# it is aligned.
+stacker = StreamingStacker(crop=crop)
+if stackmode == 'streaming':
+    for image in uptodate:
+        stacker.add(image['filter'], image['reducedpath'], image['alignment'])
+with cache, BatchWriter(db, batchsize=dbbatchsize) as writer:
+    for recno, path, sources, alignment, engine in \
+                            pool.imap_unordered(alignOneImage, todo):
+        updates = {'alignedpath':path, 'alignment':alignment, 'stacked':0}
+        if sources is not None:
+            updates['sources'] = sources
+        writer.put([recno], updates)
+        engines[engine] += 1
+        cache.done(alignmentProduct(images[recno]['reducedpath']))
+        if stackmode == 'streaming':
+            image = images[recno]
+            stacker.add(image['filter'], image['reducedpath'], alignment)
+print(f"aligned {engines['fft']} frames by cross correlation, "
+      f"{engines['astroalign']} with astroalign.")
+
+if stackmode == 'streaming':
+    for filter in stacker.accumulators:
+        writeStack(stackPath(outdir, target, filter), stacker.finish(filter))
+    print("stacks written.")
@@ -8,34 +8,58 @@ Created on Fri Apr 29 19:00:16 2022
 
 
 from pathlib import Path
-import numpy as np
-from astropy.io import fits
-from ccdproc import ImageFileCollection, Combiner
 
-from database import ImageBase
-from config import  dbname, workdir, target, outdir
+from database import ImageBase, stacksfields, stacksindexes
+from module_stack import StreamingStacker, stackPath, writeStack, \
+                         exactStack, incrementalStack
+from module_alignment import alignmentProduct
+from module_cache import ProductCache
+from config import  dbname, workdir, target, outdir, combiner, combinememory, \
+                    crop, stackmode, stackrebuild, cacheproducts, tracedir
+from module_trace import startTracing, span
+
+# (spans of this run, see module_trace.py, if tracedir is set)
+startTracing(tracedir, '5_stack')
 
 workdir = Path(workdir)
 outdir = Path(outdir)
 
 db = ImageBase(dbname)
+db.create(stacksfields, tablename='stacks', indexes=stacksindexes)
 allimages = db.select(['object'], 
                       [target],
                       returnType='dict')
 
 filters = list(set([e['filter'] for e in allimages]))
-scaling_func = lambda arr: 1/np.ma.average(arr)
-    
+
+# a stack made from the same alignments, with the same parameters, is still
+# good (the incremental stacks keep track of their frames themselves):
+cache = ProductCache(db, enabled=cacheproducts)
+
 for filter in filters:
-    relevantfiles = [e['alignedpath'] for e in allimages if e['filter'] == filter]
-    cmbcol = ImageFileCollection(filenames=relevantfiles)
-    cmb = Combiner(cmbcol.ccds(ccd_kwargs={'unit':'adu'}))
-    cmb.scaling = scaling_func
-    cmb.sigma_clipping(low_thresh=2, high_thresh=4, func=np.ma.median)
-    av = cmb.average_combine()
-    safefilter = filter.replace(' ', '').replace('/', '')
-    path = outdir / f"{target}_filter{safefilter}.fits"
-    data = av.data.astype(np.float32) 
-    data -= np.min(data)
-    data /= np.max(data)
-    fits.writeto(path, data, overwrite=True)
+    relevant = [e for e in allimages 
+                  if e['filter'] == filter and e['alignment'] is not None]
+    path = stackPath(outdir, target, filter)
+    if not stackmode == 'incremental' and \
+       cache.check(path, 'stack', 
+                   sorted(alignmentProduct(e['reducedpath']) for e in relevant),
+                   crop=crop, mode=stackmode, combiner=combiner):
+        continue
+    with span('stack', filter=filter, frames=len(relevant)):
+        if stackmode == 'incremental':
+            data = incrementalStack(db, target, filter, relevant, outdir,
+                                    crop, stackrebuild, combiner,
+                                    combinememory)
+        elif stackmode == 'streaming':
+            stacker = StreamingStacker(crop=crop)
+            for e in relevant:
+                stacker.add(filter, e['reducedpath'], e['alignment'])
+            data = stacker.finish(filter)
+        else:
+            data = exactStack([e['reducedpath'] for e in relevant],
+                              [e['alignment'] for e in relevant], crop,
+                              combiner, combinememory)
+        writeStack(path, data)
+    cache.done(path)
+cache.flush()
+print(cache.report())
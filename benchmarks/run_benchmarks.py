@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timings of the pipeline on synthetic nights (synthetic_night.py), at
+several sizes, written as JSON to compare commits:
+
+    python benchmarks/run_benchmarks.py --sizes small medium --out new.json
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+
+Two kinds of benchmarks:
+    - stages: the scripts 1_add_images.py to 5_stack.py (and
+      run_pipeline.py), each in its own process, on a night generated in a
+      temporary directory, with config.py pointing there (everything else
+      as in the repository's config.py, but with the product cache off).
+    - operations: the functions these stages spend their time in
+      (reduction, writing and reading the intermediate products, star
+      masking and fitting in the flats, source detection, alignment,
+      combination) and the ImageBase operations, in this
+      process, repeated, the median is kept. The tiled combination is
+      also checked against ccdproc's (an AssertionError if they differ).
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import numpy as np
+
+benchdir = Path(__file__).resolve().parent
+repodir = benchdir.parent
+sys.path.insert(0, str(repodir))
+sys.path.insert(0, str(benchdir))
+
+from synthetic_night import makeNight, addStars
+
+
+# name -> (shape, nbias, ndark, nflat, nscience, nstars, rows in the database)
+sizes = {'small': (256, 3, 3, 3, 6, 40, 1000),
+         'medium': (1024, 5, 5, 5, 16, 150, 10000),
+         'large': (2048, 10, 10, 10, 40, 400, 100000)}
+
+stagescripts = ['1_add_images.py', '2_make_main_calibs.py',
+                '3_reduce_images.py', '4_align.py', '5_stack.py']
+
+
+def timeit(func, repeat=3):
+    # the durations of repeat calls, and the result of the last one.
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return durations, result
+
+
+def result(name, size, durations, **extra):
+    entry = {'benchmark':name, 'size':size,
+             'seconds':float(np.median(durations)),
+             'durations':[float(d) for d in durations]}
+    entry.update(extra)
+    print(f"{size:<8} {name:<32} {entry['seconds']:9.3f} s")
+    return entry
+
+
+################################### stages ####################################
+def writeConfig(cfgdir, topdir, shape, cores):
+    """
+    config.py of the repository, pointing to topdir, for the stage scripts.
+    """
+    text = (repodir / 'config.py').read_text()
+    text = re.sub(r"^workdir = .*$", f"workdir = {str(topdir / 'work')!r}",
+                  text, flags=re.M)
+    text = re.sub(r"^datadir = .*$", f"datadir = {str(topdir)!r}",
+                  text, flags=re.M)
+    text += (f"\n# benchmark overrides:\n"
+             f"target = 'SYNTH'\n"
+             f"crop = {min(100, shape // 8)}\n"
+             f"cacheproducts = False\n")
+    if cores is not None:
+        text += f"maxcores = {cores}\n"
+    (topdir / 'work').mkdir(exist_ok=True)
+    (cfgdir / 'config.py').write_text(text)
+
+
+def runScript(cfgdir, script):
+    # the script as __main__, with the generated config.py found first.
+    code = (f"import sys, runpy; "
+            f"sys.path[:0] = [{str(cfgdir)!r}, {str(repodir)!r}]; "
+            f"runpy.run_path({str(repodir / script)!r}, run_name='__main__')")
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', code], cwd=cfgdir,
+                             capture_output=True, text=True)
+    duration = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"{script} failed:\n{process.stderr[-2000:]}")
+    return duration
+
+
+def cleanProducts(topdir):
+    # everything but the raw frames.
+    for sub in ['work', 'calibdir', 'outdir']:
+        shutil.rmtree(topdir / sub, ignore_errors=True)
+    (topdir / 'work').mkdir()
+
+
+def benchmarkStages(size, params, cores, pipeline=True):
+    shape, nbias, ndark, nflat, nscience, nstars, _ = params
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        topdir = Path(tmp) / 'night'
+        cfgdir = Path(tmp) / 'cfg'
+        cfgdir.mkdir()
+        durations, paths = timeit(lambda: makeNight(topdir, (shape, shape),
+                                                    nbias, ndark, nflat,
+                                                    nscience, nstars=nstars),
+                                  repeat=1)
+        results.append(result('generate', size, durations,
+                              frames=len(paths)))
+        writeConfig(cfgdir, topdir, shape, cores)
+        for script in stagescripts:
+            results.append(result(f"stage/{script}", size,
+                                  [runScript(cfgdir, script)],
+                                  frames=len(paths)))
+        if pipeline:
+            cleanProducts(topdir)
+            results.append(result("stage/run_pipeline.py", size,
+                                  [runScript(cfgdir, 'run_pipeline.py')],
+                                  frames=len(paths)))
+    return results
+
+
+################################# operations ##################################
+def benchmarkOperations(size, params, repeat):
+    from astropy.io import fits
+    from module_reduction import calibrationTerms, reduceFast, reduceRows
+    from module_remove_stars_flats import starMaskFromArray, \
+                                          removeStarsFromArray
+    from module_alignment import detectSources, alignFrame
+    from module_combine import combine, checkCombineAgainstCCDProc
+    from module_fitsio import writeFrame, readFrame, FitsFrame
+
+    shape, nbias, ndark, nflat, nscience, nstars, _ = params
+    results = []
+    rng = np.random.default_rng(2)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        positions = rng.uniform(0, shape, (nstars, 2))
+        fluxes = 10**rng.uniform(2.5, 4, nstars)
+
+        # reduction of one frame:
+        raw = (1300 + rng.normal(0, 5, (shape, shape))).astype(np.float32)
+        bias = np.full(raw.shape, 1000, dtype=np.float32)
+        dark = np.full(raw.shape, 12, dtype=np.float32)
+        flat = np.ones(raw.shape, dtype=np.float32)
+        offset, invflat = calibrationTerms(bias, dark, flat)[:2]
+        durations, _ = timeit(lambda: reduceFast(raw, offset, invflat),
+                              repeat)
+        results.append(result('reduceFast', size, durations))
+        # the same from the file, unsigned 16 bits like the camera's:
+        rawpath = tmp / 'raw.fits'
+        fits.writeto(rawpath, raw.astype(np.uint16))
+        def reduceFile():
+            with FitsFrame(rawpath) as frame:
+                return reduceRows(frame, offset, invflat)
+        durations, _ = timeit(reduceFile, repeat)
+        results.append(result('reduceRows/uint16 file', size, durations))
+
+        # an intermediate product written and read back, in each format:
+        reduced = reduceFast(raw, offset, invflat)
+        for compression in [None, 'RICE_1', 'GZIP_2']:
+            path = tmp / f"reduced_{compression}.fits"
+            durations, _ = timeit(lambda: writeFrame(path, reduced,
+                                                     compression=compression),
+                                  repeat)
+            results.append(result(f"writeFrame/{compression}", size,
+                                  durations, bytes=path.stat().st_size))
+            durations, _ = timeit(lambda: np.array(readFrame(path)[0]),
+                                  repeat)
+            results.append(result(f"readFrame/{compression}", size,
+                                  durations))
+
+        # stars in a flat:
+        flatarray = 20000 + addStars(np.zeros(raw.shape), positions,
+                                     fluxes / 10)
+        flatarray += rng.normal(0, 5, raw.shape)
+        durations, _ = timeit(lambda: starMaskFromArray(flatarray), repeat)
+        results.append(result('starMaskFromArray', size, durations))
+        for mode in ('serial', 'batched'):
+            durations, _ = timeit(lambda: removeStarsFromArray(
+                                      flatarray.copy(), mode=mode), repeat)
+            results.append(result(f"removeStarsFromArray/{mode}", size,
+                                  durations))
+
+        # sources and alignment:
+        crop = min(100, shape // 8)
+        sky = addStars(np.full(raw.shape, 300.), positions, fluxes)
+        sky += rng.normal(0, 5, raw.shape)
+        refpath = tmp / 'ref.fits'
+        fits.writeto(refpath, sky.astype(np.float32))
+        shifted = addStars(np.full(raw.shape, 300.), positions + [3.3, -2.1],
+                           fluxes)
+        shifted += rng.normal(0, 5, raw.shape)
+        shiftedpath = tmp / 'shifted.fits'
+        fits.writeto(shiftedpath, shifted.astype(np.float32))
+        durations, _ = timeit(lambda: detectSources(sky[crop:-crop,
+                                                        crop:-crop],
+                                                    crop=crop), repeat)
+        results.append(result('detectSources', size, durations))
+        for engine in ['auto', 'astroalign']:
+            # (the reference is prepared by the first call, then cached)
+            alignFrame(shiftedpath, None, refpath, None, 0, crop, engine)
+            durations, (_, _, used) = timeit(
+                lambda: alignFrame(shiftedpath, None, refpath, None, 0, crop,
+                                   engine), repeat)
+            results.append(result(f"alignFrame/{engine}", size, durations,
+                                  used=used))
+
+        # combination of nflat frames:
+        paths = []
+        for i in range(nflat):
+            path = tmp / f"flat{i}.fits"
+            fits.writeto(path, (flatarray + rng.normal(0, 5, raw.shape))
+                                                          .astype(np.float32))
+            paths.append(path)
+        for engine in ['tiled', 'ccdproc']:
+            durations, _ = timeit(lambda: combine(paths, engine=engine),
+                                  repeat)
+            results.append(result(f"combine/{engine}", size, durations,
+                                  frames=nflat))
+        # and the tiled combination must give what ccdproc gives, with
+        # several tiles (small budget), scaled or not, and with the masks
+        # of the flats (stars masked in every frame):
+        maskedpaths = []
+        for i, path in enumerate(paths):
+            data = fits.getdata(path)
+            maskedpath = tmp / f"maskedflat{i}.fits"
+            writeFrame(maskedpath, data, mask=starMaskFromArray(data))
+            maskedpaths.append(maskedpath)
+        budget = nflat * shape * 20 * (shape // 7)
+        for name, frames, kwargs in [
+                ('plain', paths, {}),
+                ('mean', paths, {'scaling':'mean'}),
+                ('masked', maskedpaths, {'scaling':'mean'}),
+                ('unmaskifall', maskedpaths, {'scaling':'mean', 
+                                              'unmaskifall':True})]:
+            durations, difference = timeit(
+                lambda: checkCombineAgainstCCDProc(frames, 
+                                                   memorybudget=budget, 
+                                                   **kwargs), 1)
+            results.append(result(f"combine/check {name}", size, durations,
+                                  difference=float(difference)))
+    return results
+
+
+def benchmarkDatabase(size, params, repeat):
+    from database import ImageBase, minimaldbfields, minimaldbindexes
+
+    nrows = params[-1]
+    results = []
+    rng = np.random.default_rng(3)
+    rows = [{'path':f"/data/frame{i}.fits",
+             'imagetyp':['Light Frame', 'Flat Field', 'Dark Frame',
+                         'Bias Frame'][i % 4],
+             'exptime':float([60, 10, 60, 0][i % 4]), 'binning':3,
+             'object':f"target{i % 20}", 'filter':['R', 'G', 'B'][i % 3],
+             'mjd':59696 + i / 1000, 'night':f"2022-04-{1 + i % 28:02d}",
+             'airmass':float(rng.uniform(1, 2))} for i in range(nrows)]
+    with tempfile.TemporaryDirectory() as tmp:
+        def fresh():
+            dbname = Path(tmp) / f"db{time.perf_counter_ns()}.db"
+            db = ImageBase(dbname, wal=True)
+            db.create(minimaldbfields, indexes=minimaldbindexes)
+            return db
+
+        # a new database for each insertion:
+        durations = []
+        for _ in range(repeat):
+            db = fresh()
+            start = time.perf_counter()
+            db.insertBatch(rows)
+            durations.append(time.perf_counter() - start)
+        results.append(result('db/insertBatch', size, durations, rows=nrows))
+
+        durations, _ = timeit(lambda: db.select(['object'], ['target7'],
+                                                returnType='dict'), repeat)
+        results.append(result('db/select', size, durations, rows=nrows))
+        durations, _ = timeit(lambda: db.selectGroups(
+                                  ['binning', 'filter', 'night'],
+                                  ['imagetyp'], ['Flat Field'],
+                                  sortFields=['mjd']), repeat)
+        results.append(result('db/selectGroups', size, durations, rows=nrows))
+        recnos = db.execute("select recno from images", singlereturn=True)
+        durations, _ = timeit(lambda: db.updateBatch(
+                                  ['recno'], [[r] for r in recnos],
+                                  [{'reducedpath':f"/work/{r}_red.fits"}
+                                                          for r in recnos]),
+                              repeat)
+        results.append(result('db/updateBatch', size, durations, rows=nrows))
+    return results
+
+
+################################### output ####################################
+def gitDescription():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=repodir, text=True,
+                              capture_output=True).stdout.strip()
+    return {'commit':git('rev-parse', 'HEAD') or None,
+            'dirty':len(git('status', '--porcelain', '--untracked-files=no'))
+                                                                        > 0}
+
+
+def environment():
+    import astropy, scipy
+    return {'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host':platform.node(), 'machine':platform.machine(),
+            'cpus':os.cpu_count(), 'python':platform.python_version(),
+            'numpy':np.__version__, 'scipy':scipy.__version__,
+            'astropy':astropy.__version__}
+
+
+def compare(oldpath, newpath, threshold=0.1):
+    """
+    prints the ratio new/old of each benchmark present in both, flagging
+    those more than threshold slower.
+    """
+    old, new = [{(r['benchmark'], r['size']):r['seconds']
+                  for r in json.loads(Path(p).read_text())['results']}
+                 for p in (oldpath, newpath)]
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / max(old[key], 1e-9)
+        flag = 'SLOWER' if ratio > 1 + threshold else \
+               'faster' if ratio < 1 - threshold else ''
+        print(f"{key[1]:<8} {key[0]:<32} {old[key]:9.3f} -> {new[key]:9.3f} s"
+              f"  x{ratio:5.2f} {flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['small'],
+                        choices=list(sizes))
+    parser.add_argument('--only', choices=['stages', 'operations', 'database'],
+                        nargs='+', default=['stages', 'operations', 'database'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cores', type=int, default=None,
+                        help="maxcores of the stages (default: config.py)")
+    parser.add_argument('--no-pipeline', action='store_true',
+                        help="do not time run_pipeline.py")
+    parser.add_argument('--out', default=None, help="JSON file to write")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two JSON files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    results = []
+    for size in args.sizes:
+        params = sizes[size]
+        if 'stages' in args.only:
+            results += benchmarkStages(size, params, args.cores,
+                                       not args.no_pipeline)
+        if 'operations' in args.only:
+            results += benchmarkOperations(size, params, args.repeat)
+        if 'database' in args.only:
+            results += benchmarkDatabase(size, params, args.repeat)
+
+    output = {'git':gitDescription(), 'environment':environment(),
+              'sizes':{size:dict(zip(['shape', 'nbias', 'ndark', 'nflat',
+                                      'nscience', 'nstars', 'dbrows'],
+                                     sizes[size])) for size in args.sizes},
+              'results':results}
+    if args.out is not None:
+        Path(args.out).write_text(json.dumps(output, indent=1))
+        print(f"written to {args.out}")
+    else:
+        print(json.dumps(output, indent=1))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A synthetic night of Telesto data, to benchmark the pipeline without the
+real thing: biases, darks, twilight flats (with a few stars, dithered) and
+science frames of a star field (Moffat stars, dithered, optionally rotated),
+with the header keys 1_add_images.py reads.
+
+    python benchmarks/synthetic_night.py /tmp/synth --shape 1024 --nscience 20
+
+writes the fits files in /tmp/synth/raw.
+"""
+
+import argparse
+from pathlib import Path
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time, TimeDelta
+
+
+def addStars(image, positions, fluxes, gamma=2.5, alpha=2.5, radius=15):
+    # Moffat profiles, each drawn on its own stamp (not on the whole frame).
+    ny, nx = image.shape
+    for (x, y), flux in zip(positions, fluxes):
+        x0, x1 = max(int(x) - radius, 0), min(int(x) + radius + 1, nx)
+        y0, y1 = max(int(y) - radius, 0), min(int(y) + radius + 1, ny)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        r2 = ((xx - x)**2 + (yy - y)**2) / gamma**2
+        image[y0:y1, x0:x1] += flux * (1 + r2)**-alpha
+    return image
+
+
+def shiftAndRotate(positions, dx, dy, angle, shape):
+    # the star positions as seen by a frame pointed dx, dy pixels away and
+    # rotated by angle degrees around the centre.
+    centre = np.array(shape[::-1]) / 2
+    theta = np.deg2rad(angle)
+    rotation = np.array([[np.cos(theta), -np.sin(theta)],
+                         [np.sin(theta), np.cos(theta)]])
+    return (positions - centre) @ rotation.T + centre + [dx, dy]
+
+
+def writeFrame(path, data, imagetyp, exptime, filter, dateobs, object,
+               binning=3, rng=None, noise=5.):
+    header = fits.Header()
+    header['IMAGETYP'] = imagetyp
+    header['EXPTIME'] = exptime
+    header['XBINNING'] = binning
+    header['AIRMASS'] = 1.1
+    header['OBJECT'] = object
+    header['FOCPOS'] = 1000.
+    header['FILTER'] = filter
+    header['DATE-OBS'] = dateobs
+    header['CCD-TEMP'] = -10.
+    if rng is not None:
+        data = data + rng.normal(0, noise, data.shape)
+    fits.writeto(path, data.astype(np.float32), header, overwrite=True)
+
+
+def makeNight(topdir, shape=(512, 512), nbias=5, ndark=5, nflat=5,
+              nscience=8, filters=('R',), target='SYNTH', date='2022-04-27',
+              nstars=80, dither=5., rotation=0., binning=3, seed=1,
+              bias='Bias Frame', dark='Dark Frame', flat='Flat Field',
+              light='Light Frame'):
+    """
+    writes the frames to topdir/raw, returns their paths.
+    nflat and nscience are per filter. The science frames are dithered by up
+    to dither pixels, and rotated by up to rotation degrees (0: only
+    shifted, the frames the cross correlation aligns).
+    """
+    rng = np.random.default_rng(seed)
+    rawdir = Path(topdir) / 'raw'
+    rawdir.mkdir(parents=True, exist_ok=True)
+    ny, nx = shape
+    yy, xx = np.mgrid[:ny, :nx]
+    # the sky, in pixels of the first science frame:
+    margin = 4 * dither + 10
+    stars = rng.uniform([-margin, -margin], [nx + margin, ny + margin],
+                        (nstars, 2))
+    fluxes = 10**rng.uniform(2.5, 4, nstars)
+    # the instrument:
+    biaslevel = 1000 + rng.normal(0, 2, shape)
+    darkcurrent = np.full(shape, 0.2)
+    hot = rng.integers(0, ny * nx, max(ny * nx // 20000, 1))
+    darkcurrent.flat[hot] = 50.
+    r2 = ((xx - nx/2)**2 + (yy - ny/2)**2) / (nx**2/4 + ny**2/4)
+    vignetting = 1 - 0.15 * r2
+    start = Time(f"{date}T17:00:00")
+    paths = []
+
+    def dateobs(minutes):
+        return (start + TimeDelta(60 * minutes, format='sec')).isot
+
+    def save(name, data, imagetyp, exptime, filter, minutes, object):
+        path = rawdir / f"{name}.fits"
+        writeFrame(path, data, imagetyp, exptime, filter, dateobs(minutes),
+                   object, binning=binning, rng=rng)
+        paths.append(path)
+
+    for i in range(nbias):
+        save(f"bias{i}", biaslevel, bias, 0., filters[0], i, 'bias')
+    for i in range(ndark):
+        save(f"dark{i}", biaslevel + 60 * darkcurrent, dark, 60.,
+             filters[0], 30 + i, 'dark')
+    minutes = 60
+    for filter in filters:
+        for i in range(nflat):
+            # twilight: a few faint stars, moving from flat to flat.
+            sky = addStars(np.zeros(shape), stars + [15 * i, 11 * i],
+                           fluxes / 10)
+            save(f"flat_{filter}{i}",
+                 biaslevel + 10 * darkcurrent + (20000 + sky) * vignetting,
+                 flat, 10., filter, minutes, 'flat')
+            minutes += 1
+    minutes = 300
+    for filter in filters:
+        for i in range(nscience):
+            frac = i / max(nscience - 1, 1)
+            dx, dy = rng.uniform(-dither, dither, 2)
+            positions = shiftAndRotate(stars, dx, dy, rotation * frac, shape)
+            sky = addStars(np.full(shape, 300.), positions, fluxes)
+            save(f"sci_{filter}{i}",
+                 biaslevel + 60 * darkcurrent + sky * vignetting,
+                 light, 60., filter, minutes, target)
+            minutes += 1.5
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('topdir')
+    parser.add_argument('--shape', type=int, default=512)
+    parser.add_argument('--nbias', type=int, default=5)
+    parser.add_argument('--ndark', type=int, default=5)
+    parser.add_argument('--nflat', type=int, default=5)
+    parser.add_argument('--nscience', type=int, default=8)
+    parser.add_argument('--filters', default='R')
+    parser.add_argument('--nstars', type=int, default=80)
+    parser.add_argument('--rotation', type=float, default=0.)
+    args = parser.parse_args()
+    paths = makeNight(args.topdir, (args.shape, args.shape), args.nbias,
+                      args.ndark, args.nflat, args.nscience,
+                      args.filters.split(','), nstars=args.nstars,
+                      rotation=args.rotation)
+    print(f"wrote {len(paths)} frames to {Path(args.topdir) / 'raw'}")
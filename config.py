@@ -26,6 +26,90 @@ crop = 100
 
 # for alignment, how many cores?
 maxcores = 4
+
+# the alignment only stores the transform of each frame in the database, the
+# stacking warps the frames as it reads them. Set to True to also write the
+# aligned frames (_aligned.fits in workdir), e.g. to look at them.
+writealigned = False
+# how we find the transforms: 'auto' (cross correlation with the reference 
+# when the frame is only shifted, astroalign otherwise) or 'astroalign' (always
+# match asterisms).
+alignengine = 'auto'
+
+# stacking: 'exact' (clipping around the median, with the combiner above, 
+# once all the frames are aligned), 'streaming' (the frames go into running
+# sums as soon as they are aligned, by 4_align.py, and the clipping is around
+# the mean, in a second pass) or 'incremental' (like streaming, but the sums
+# are saved and only the new frames are added to them at each run).
+# Clipping around the mean rejects a little less than around the median:
+# the streaming and incremental stacks are close to the exact one, not 
+# identical.
+stackmode = 'exact'
+# incremental: start over from all the frames (and write the exact stack).
+stackrebuild = False
+
+# the pool workers read the database while the parent process writes their
+# results: put the database in write-ahead-logging mode, and commit the
+# results by batches of dbbatchsize rows.
+dbwal = True
+dbbatchsize = 100
+
+# reduction of the science frames: 'fast' (bias, dark and flat applied in 
+# one float32 pass) or 'ccdproc' (the ccdproc chain, our reference).
+reductionengine = 'fast'
+# ccdproc's subtract_dark does not scale the dark to the exposure time of the
+# frame unless asked to, and we never asked. Set to True to scale.
+scaledark = False
+# propagate the uncertainties of the main calibrations (they keep their
+# variance), written as a VARIANCE extension of the reduced frames (fast
+# engine only):
+reductionvariance = False
+# compare the fast engine to ccdproc on the first frame before starting
+# (a check of the fast engine, nothing to compare with the ccdproc one):
+checkreduction = False
+# the intermediate products (main calibrations, reduced and aligned frames)
+# are float32, with a VARIANCE extension only if reductionvariance. They can
+# also be tile compressed: None (plain fits), 'RICE_1' (quantized at 1/16 of
+# the noise, about 4 times smaller, lossy but far below the noise) or 'GZIP_2'
+# (lossless, smaller by a third on noisy frames). Compressing costs cpu time
+# (tens of ms per frame): worth it when the shared filesystem is what we wait
+# for, not on a local disk. See module_fitsio.py.
+intermediatecompression = None
+
+# combination of the main calibrations and of the stacks: 'tiled' (goes 
+# through the frames by tiles of rows, at most combinememory bytes in memory)
+# or 'ccdproc' (ccdproc's Combiner, all the frames in memory).
+combiner = 'tiled'
+combinememory = 2e9
+
+# stars in the flats: 'fit' (a Moffat profile is fitted and subtracted for 
+# each star) or 'mask' (faster: their pixels are flagged and left out when 
+# combining the flats, enough for dithered flats).
+flatstarremoval = 'fit'
+# with 'fit': 'batched' (the stars of a flat fitted together, vectorised,
+# the detections that are only noise left alone) or 'serial' (one astropy 
+# LevMarLSQFitter per detection, slow).
+moffatfitter = 'batched'
+
+# skip the products (main calibrations, reduced frames, alignments) made by a
+# previous run from the same inputs with the same parameters, if they are 
+# still there. Set to False to make everything again.
+cacheproducts = True
+
+# where the time goes: set to a directory (e.g. join(workdir, 'traces')) to 
+# record spans of every frame and operation, in every process, with the bytes
+# read and written, the peak memory and the sqlite queries. Each script then
+# writes a chrome trace (<script>_trace.json, for chrome://tracing or 
+# ui.perfetto.dev) there and prints a summary.
+tracedir = None
+
+# how many threads read the fits headers when adding images to the database?
+ingestthreads = 16
+
+# local time minus UTC at the telescope, in hours. Frames are grouped by
+# observing night, from local noon to local noon (no daylight saving time, 
+# being an hour off does not move the noon cut to the middle of a night).
+utcoffset = 1
 ###############################################################################
 # ok, now we specify the oject (or list of objects) we want to reduce, 
 # as well as a date:
@@ -7,6 +7,15 @@
 import sqlite3 as sq
 
 import re, datetime, io
+import threading, queue, multiprocessing
+from pathlib import PosixPath, WindowsPath
+
+from module_trace import span, countQueries
+
+# we pass pathlib paths around everywhere in the scripts, let sqlite3
+# store them as text when they are bound as parameters:
+sq.register_adapter(PosixPath, str)
+sq.register_adapter(WindowsPath, str)
 
 # used to test columns against regexprs:
 def regexp(expr, item):
@@ -26,7 +35,7 @@ SQLiteTypeTotype = {v:k for k,v in typeToSQLiteType.items()}
 DEBUG = False
 
 class ImageBase():
-    def __init__(self, dbname, fast=False):
+    def __init__(self, dbname, fast=False, wal=False, timeout=60):
         # unlike KirbyBase, can store multilpe tables in an SQlite base.
         # thus give a default one:
         self.defaulttable = "images"
@@ -35,14 +44,35 @@ class ImageBase():
         
         self.dbname = dbname
                 
+        # the schema (tables and their columns) is looked up for nearly every
+        # select, insert or update. Cache it here, create/addFields/dropFields
+        # invalidate it. Count how many pragma queries we saved:
+        self._schemacache = {}
+        self.schemaqueriesavoided = 0
+        
+        # how long (seconds) a connection waits for a lock held by another 
+        # process before giving up with "database is locked":
+        self.timeout = timeout
+        
+        # write-ahead logging (see below):
+        self.wal = wal
+        
         # "fast" when adding or updating tons of rows in series, 
         # open the connection only once and store it in this object.
         self.fast = fast
         if self.fast:
-            self.conn = sq.connect(dbname)
+            self.conn = self._newConnection()
         else:
             # then open the connetion at each execute
             self.conn = None
+            
+        # write-ahead logging: readers no longer block the writer and 
+        # vice versa, which is what we want when pool workers read the 
+        # database while the parent writes their results.
+        # The journal mode is stored in the database file itself, 
+        # so setting it once is enough.
+        if self.wal:
+            self.execute("PRAGMA journal_mode=WAL")
         
     def __del__(self):
         if self.fast:
@@ -69,10 +99,12 @@ class ImageBase():
         """
         if not (type(sqlstatements) is list):
             sqlstatements = [sqlstatements]
-        if self.fast:
-            conn = self.conn
-        else: 
-            conn = sq.connect(self.dbname)
+        with span('sqlite', statements=len(sqlstatements)):
+            countQueries(len(sqlstatements))
+            return self._execute(sqlstatements, singlereturn)
+    
+    def _execute(self, sqlstatements, singlereturn):
+        conn = self._connect()
         results = []
         with conn:
             # context manager: locks the database while we execute every sql 
@@ -101,6 +133,51 @@ class ImageBase():
             return results[0]
         return results
     
+    def executeMany(self, statements):
+        """
+        statements: list of (sqlstatement, listofparameters) tuples.
+        
+        Here we do let sqlite3 bind the parameters: each sql statement is
+        compiled once and run for every tuple of parameters 
+        (cursor.executemany), and everything happens in one transaction on
+        one connection. This is what we want when inserting or updating
+        thousands of rows.
+        
+        returns the number of rows affected by each statement.
+        """
+        with span('sqlite', statements=len(statements)):
+            countQueries(sum(len(params) for _, params in statements))
+            return self._executeMany(statements)
+    
+    def _executeMany(self, statements):
+        conn = self._connect()
+        rowcounts = []
+        with conn:
+            for sqlstatement, params in statements:
+                if self.debug:
+                    print(sqlstatement, f"({len(params)} parameter sets)")
+                if 'regexp' in sqlstatement.lower():
+                    conn.create_function("REGEXP", 2, regexp)
+                cur = conn.cursor()
+                cur.executemany(sqlstatement, params)
+                rowcounts.append(cur.rowcount)
+            conn.commit()
+        if not self.fast:
+            conn.close()
+        return rowcounts
+    
+    def _connect(self):
+        if self.fast:
+            return self.conn
+        return self._newConnection()
+    
+    def _newConnection(self):
+        conn = sq.connect(self.dbname, timeout=self.timeout)
+        if self.wal:
+            # safe with WAL, and far fewer fsyncs:
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
     
     def _formatFields(self, fields):
         """
@@ -131,18 +208,47 @@ class ImageBase():
         return typ
 
 
+    def invalidateSchema(self, tablename=None):
+        """
+        forget what we know about the schema of tablename (or of
+        everything if tablename is None). Done automatically by create,
+        addFields and dropFields -- but if another process alters the 
+        tables, call this by hand.
+        """
+        if tablename is None:
+            self._schemacache = {}
+        else:
+            self._schemacache.pop(tablename, None)
+            self._schemacache.pop('___tables___', None)
+    
     def getTableNames(self):
         # pretty self exlpanatory: get the names of all 
         # the tables in our database.
+        if '___tables___' in self._schemacache:
+            self.schemaqueriesavoided += 1
+            return list(self._schemacache['___tables___'])
         tabs = self.execute( 
                     "SELECT name FROM sqlite_master WHERE type='table';")
-        return [t[0] for t in tabs]
+        tabs = [t[0] for t in tabs]
+        self._schemacache['___tables___'] = tabs
+        return list(tabs)
     
     def getColumns(self, tablename=None):
         if not tablename:
             tablename = self.defaulttable
-        return self.execute( 
+        if tablename in self._schemacache:
+            self.schemaqueriesavoided += 1
+            return self._schemacache[tablename]['columns']
+        columns = self.execute( 
                     f"select name,type from pragma_table_info('{tablename}')")
+        if len(columns) > 0:
+            # (an empty result means that the table does not exist (yet),
+            # do not cache that.)
+            types = {name:SQLiteTypeTotype[typ.lower()] 
+                                            for name, typ in columns}
+            self._schemacache[tablename] = {'columns':columns, 
+                                            'types':types}
+        return columns
     
     def getFieldNames(self, tablename=None):
         if not tablename:
@@ -158,14 +264,13 @@ class ImageBase():
     def getColumnType(self, field, tablename=None):
         if not tablename:
             tablename = self.defaulttable 
-        fields = self.getFieldNames(tablename)
-        types = self.getFieldTypes(tablename)
-        if not field in fields:
+        self.getColumns(tablename)
+        types = self._schemacache.get(tablename, {'types':{}})['types']
+        if not field in types:
             raise AssertionError(f"no such field ({field}) in table {tablename}")
-        matchindex = fields.index(field)
-        return types[matchindex]
+        return types[field]
 
-    def create(self, fields, tablename=None, exist_ok=True):
+    def create(self, fields, tablename=None, exist_ok=True, indexes=[]):
         """
         creates a table in the database.
         In our context, usually we create only one table 
@@ -181,6 +286,9 @@ class ImageBase():
             if true, doesn't mind that the table already exists and simply 
             does nothing.
             if false, will crash if the table exists.
+        indexes : list of lists of field names
+            e.g. [['object'], ['imagetyp', 'binning']]: indexes created 
+            (if not already there) with createIndex.
 
         Returns
         -------
@@ -195,8 +303,9 @@ class ImageBase():
             
         if tablename in self.getTableNames():
             if exist_ok:
-                for field in fields:
-                    self.addFields(fields, tablename=tablename)
+                self.addFields(fields, tablename=tablename)
+                for index in indexes:
+                    self.createIndex(index, tablename=tablename)
                 return []
             else:
                 raise RuntimeError(f"table {tablename} already exists!")
@@ -206,7 +315,11 @@ class ImageBase():
         
         cmd += self._formatFields(fields)
         cmd = cmd[:-1] + ")"
-        return self.execute(cmd)
+        result = self.execute(cmd)
+        self.invalidateSchema(tablename)
+        for index in indexes:
+            self.createIndex(index, tablename=tablename)
+        return result
     
     def addFields(self, listoffields, tablename=None, exist_ok=True):
         if not tablename:
@@ -226,7 +339,8 @@ class ImageBase():
                 if exist_ok:
                     matchindex = colnames.index(name)
                     oldtyp = coltypes[matchindex]
-                    if not oldtyp == typ:
+                    # recent sqlite versions report the types in upper case.
+                    if not oldtyp.lower() == typ:
                         raise RuntimeError(f"can't change type of existing column: {col}!")
                     # if column exists, and we fine with that and the type matches:
                     # go to next.
@@ -235,7 +349,61 @@ class ImageBase():
                     raise RuntimeError(f"column {col} already exists!")
             else:
                 self.execute(f"alter table {tablename} add {name} {typ}")
+                self.invalidateSchema(tablename)
                 
+    def setUnique(self, field, tablename=None):
+        """
+        enforces that no two rows share the same value of field.
+        If duplicates are already there (e.g. from older versions of
+        1_add_images.py), we keep the oldest row (smallest recno) and delete
+        the others before creating the unique index.
+        """
+        if not tablename:
+            tablename = self.defaulttable
+        if not field in self.getFieldNames(tablename):
+            raise AssertionError(f"no such field ({field}) in table {tablename}")
+        req1 = (f"delete from {tablename} where recno not in "
+                f"(select min(recno) from {tablename} group by {field})")
+        self.execute(req1)
+        self.createIndex([field], tablename=tablename, unique=True)
+        
+    def createIndex(self, fields, tablename=None, unique=False):
+        """
+        creates (if not already there) an index on the given list of fields.
+        An index on ['a', 'b', 'c'] also serves queries on 'a' alone or on
+        'a' and 'b', so no need to add those separately.
+        """
+        if not tablename:
+            tablename = self.defaulttable
+        allfields = self.getFieldNames(tablename)
+        for field in fields:
+            if not field in allfields:
+                raise AssertionError(f"no such field ({field}) in table {tablename}")
+        name = f"{tablename}_{'_'.join(fields)}"
+        if unique:
+            name += "_unique"
+        kind = "unique index" if unique else "index"
+        self.execute(f"create {kind} if not exists {name} "
+                     f"on {tablename}({','.join(fields)})")
+        
+    def getIndexes(self, tablename=None):
+        """
+        returns the indexes of the table as a list of 
+        (name, unique, [fields]) tuples.
+        (the automatic indexes of sqlite, e.g. for primary keys, are left out)
+        """
+        if not tablename:
+            tablename = self.defaulttable
+        indexes = self.execute(f"select name, [unique] from "
+                               f"pragma_index_list('{tablename}') "
+                               f"where origin=='c'")
+        result = []
+        for name, unique in indexes:
+            fields = self.execute(f"select name from pragma_index_info('{name}') "
+                                  f"order by seqno", singlereturn=True)
+            result.append((name, bool(unique), fields))
+        return result
+        
     def dropFields(self, fields, talbename=None):
         """
         soooo sqlite 3.35 can do this. 
@@ -243,9 +411,15 @@ class ImageBase():
         hence we copy the table without those columns, destroy the old table
         and rename the new one to the old name.
         """
-        if not talbename:
+        tablename = talbename
+        if not tablename:
             tablename = self.defaulttable
         tmptable = tablename+"___tmp___"
+        # the indexes are dropped with the old table, remember the ones 
+        # that do not involve the dropped fields to create them again:
+        keptindexes = [(unique, indexfields) 
+                         for _, unique, indexfields in self.getIndexes(tablename)
+                            if not any(f in fields for f in indexfields)]
         allfields = self.getFieldNames(tablename)
         alltypes  = [typeToSQLiteType[t] 
                                for t in self.getFieldTypes(tablename)]
@@ -264,32 +438,44 @@ class ImageBase():
         req3 = f'drop table {tablename}'
         req4 = f'alter table {tmptable} rename to {tablename}'
         self.execute([req1, req2, req3, req4])
+        self.invalidateSchema(tablename)
+        for unique, indexfields in keptindexes:
+            self.createIndex(indexfields, tablename=tablename, unique=unique)
         
         
                 
     def insertBatch(self, listOfDics, tablename=None):
+        """
+        inserts all the rows with bound parameters, in a single transaction.
+        Consecutive rows with the same keys share one executemany call.
+        """
         if not tablename:
             tablename = self.defaulttable
-            
+        statements = []
+        for keys, rows in self._groupByKeys(listOfDics):
+            colnames = ','.join(keys)
+            placeholders = ','.join('?' for k in keys)
+            cmd = f"insert into {tablename} ({colnames}) values ({placeholders})"
+            statements.append((cmd, [tuple(dic[k] for k in keys) 
+                                                          for dic in rows]))
+        if len(statements) == 0:
+            return 0
+        return sum(self.executeMany(statements))
+    
+    def _groupByKeys(self, listOfDics):
+        # splits a list of dictionaries into runs of consecutive
+        # dictionaries having the same keys (in the same order)
+        groups = []
         for dic in listOfDics:
-            self.insert(dic, tablename=tablename)
+            keys = tuple(dic.keys())
+            if len(groups) > 0 and groups[-1][0] == keys:
+                groups[-1][1].append(dic)
+            else:
+                groups.append((keys, [dic]))
+        return groups
         
     def insert(self, dic, tablename=None):
-        if not tablename:
-            tablename = self.defaulttable
-        colnames, colvals = "(", "("
-        for name, val in dic.items():
-            colnames += f"{name},"
-            # if val is None, call it NULL:
-            if val is None:
-                val = "NULL"
-            if self.getColumnType(field=name, tablename=tablename) == 'str':
-                colvals += f"'{val}',"
-            else:
-                colvals += f"{val},"
-        colnames, colvals = colnames[:-1]+")", colvals[:-1]+")"
-        cmd = f"insert into {tablename} {colnames} values {colvals}"
-        return self.execute(cmd)
+        return self.insertBatch([dic], tablename=tablename)
 
 
     def select(self, fields, searchData, filter=None, useRegExp=False, 
@@ -420,6 +606,27 @@ class ImageBase():
         
         return result
     
+    def selectGroups(self, groupFields, fields, searchData, useRegExp=False,
+                     sortFields=[], tablename=None):
+        """
+        like select(..., returnType='dict'), but the rows come bucketed by
+        the values of groupFields, in one query:
+            
+            db.selectGroups(['binning', 'night'], ['imagetyp'], [bias])
+            -> {(3, '2022-04-27'): [{row}, {row}, ...], 
+                (3, '2022-04-28'): [...], ...}
+                
+        (within a group, the rows are sorted by sortFields)
+        """
+        rows = self.select(fields, searchData, useRegExp=useRegExp,
+                           sortFields=list(groupFields)+list(sortFields),
+                           returnType='dict', tablename=tablename)
+        groups = {}
+        for row in rows:
+            key = tuple(row[f] for f in groupFields)
+            groups.setdefault(key, []).append(row)
+        return groups
+    
     
     def update(self, fields, searchData, updates, filter=None, 
                useRegExp=False, tablename=None):
@@ -428,23 +635,14 @@ class ImageBase():
 
         req = f"update {tablename} "
         if type(updates) is dict:
-            sets = []
-            for k, v in updates.items():
-                if self.getColumnType(k, tablename) == "str":
-                    sets.append(f"{k}='{v}'")
-                else:
-                    sets.append(f"{k}={v}")
-            sets = ','.join(sets)
+            setnames = list(updates.keys())
+            setvals = list(updates.values())
         elif type(updates) is list:
             assert type(filter) is list 
             assert len(filter) == len(updates)
-            sets = []
-            for k, v in zip(filter, updates):
-                if self.getColumnType(k, tablename) == "str":
-                    sets.append(f"{k}='{v}'")
-                else:
-                    sets.append(f"{k}={v}")
-            sets = ','.join(sets)
+            setnames = filter
+            setvals = updates
+        sets = ','.join(f"{k}=?" for k in setnames)
         
         req += f"set {sets} "
         conditions = []
@@ -466,11 +664,130 @@ class ImageBase():
             req += f"where {conditions} "
         # also, kirbybase gives us the number of affected rows when 
         # doing an update. Let's do this as well:
-        reqs = [req, "select total_changes()"]
-        result = self.execute(reqs)
-        return result[-1][0][0]
+        return self.executeMany([(req, [tuple(setvals)])])[0]
+    
+    def updateBatch(self, fields, listOfSearchData, listOfUpdates, 
+                    tablename=None):
+        """
+        one update per element of listOfSearchData / listOfUpdates, e.g.
+        
+            db.updateBatch(['recno'], [[1], [2]], 
+                           [{'reducedpath':p1}, {'reducedpath':p2}])
+        
+        unlike update, the search data are plain values matched
+        for equality (no operators, no regexps), and everything is bound
+        as parameters and run with executemany in one transaction.
+        
+        returns the total number of rows affected.
+        """
+        if not tablename:
+            tablename = self.defaulttable
+        assert len(listOfSearchData) == len(listOfUpdates)
+        conditions = " and ".join(f"{field}=?" for field in fields)
+        statements = []
+        # group by the updated columns, keeping the search data along:
+        rows = [dict(updates, ___search___=tuple(searchData)) 
+                 for searchData, updates in zip(listOfSearchData, listOfUpdates)]
+        for keys, group in self._groupByKeys(rows):
+            keys = keys[:-1]
+            sets = ','.join(f"{k}=?" for k in keys)
+            cmd = f"update {tablename} set {sets} where {conditions}"
+            params = [tuple(row[k] for k in keys) + row['___search___'] 
+                                                            for row in group]
+            statements.append((cmd, params))
+        if len(statements) == 0:
+            return 0
+        return sum(self.executeMany(statements))
     
     
+class BatchWriter():
+    """
+    a single writer for the results of a pool of workers.
+    
+    Instead of every worker opening its own connection to update its row
+    (lock contention as soon as we have more than a few workers),
+    results are put in a queue and one thread in the parent process commits
+    them with updateBatch, batchsize rows at a time (or whatever is pending
+    after flushinterval seconds).
+    
+    Either the workers return their results and the parent puts them:
+    
+        with BatchWriter(db) as writer:
+            for recno, path in pool.imap_unordered(reduce, allimages):
+                writer.put([recno], {'reducedpath':path})
+                
+    or, since the queue is a multiprocessing queue, workers forked after
+    the creation of the writer can call writer.put themselves.
+    
+    db should not be a "fast" ImageBase: the writing happens in another 
+    thread than the one that opened the connection.
+    """
+    def __init__(self, db, fields=['recno'], batchsize=100, 
+                 flushinterval=2., tablename=None):
+        self.db = db
+        self.fields = fields
+        self.batchsize = batchsize
+        self.flushinterval = flushinterval
+        self.tablename = tablename
+        self.queue = multiprocessing.Queue()
+        self.nwritten = 0
+        self.thread = None
+        self.error = None
+        
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+    
+    def put(self, searchData, updates):
+        self.queue.put((searchData, updates))
+        
+    def close(self):
+        # None is our "we're done" signal:
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *args):
+        self.close()
+        
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            # raised again in close, in the parent's thread.
+            self.error = e
+            
+    def _loop(self):
+        pending = []
+        done = False
+        while not done:
+            try:
+                item = self.queue.get(timeout=self.flushinterval)
+                if item is None:
+                    done = True
+                else:
+                    pending.append(item)
+            except queue.Empty:
+                # nothing came in for a while, write what we have.
+                item = None
+            if len(pending) >= self.batchsize or \
+               (item is None and len(pending) > 0):
+                self._flush(pending)
+                pending = []
+                
+    def _flush(self, pending):
+        self.db.updateBatch(self.fields, 
+                            [searchData for searchData, _ in pending],
+                            [updates for _, updates in pending],
+                            tablename=self.tablename)
+        self.nwritten += len(pending)
+        
+        
 # our database will look like this:
 minimaldbfields = ['path:str', 
                    'reducedpath:str',
@@ -483,7 +800,54 @@ minimaldbfields = ['path:str',
                    'focpos:float',
                    'filter:str',
                    'dateobs:str',
-                   'ccdtemp:float'
+                   # dateobs as a modified julian date, for date arithmetic:
+                   'mjd:float',
+                   # the observing night, local noon to local noon, named 
+                   # after the date of its evening:
+                   'night:str',
+                   'ccdtemp:float',
+                   # to know whether a file changed since we last read it:
+                   'filesize:int',
+                   'filemtime:float',
+                   # the control points of the reduced frame used for the 
+                   # alignment (JSON), so that we detect them only once:
+                   'sources:str',
+                   # the transform onto the reference frame (JSON: 3x3 matrix
+                   # in full frame coordinates, value of the empty pixels):
+                   'alignment:str',
+                   # 1 once the frame is in the persisted stack of its 
+                   # target and filter:
+                   'stacked:int'
                    ]
+
+# and the queries the pipeline runs all the time are on these fields. 
+# (an index on a,b,c also serves queries on a,b)
+minimaldbindexes = [['object'],
+                    ['imagetyp', 'binning', 'exptime', 'night'],
+                    ['imagetyp', 'binning', 'filter', 'night']
+                    ]
+
+# the main calibrations get their own tables:
+mainbiasfields = ['date:str', 'mjd:float', 'binning:int', 'path:str']
+mainbiasindexes = [['binning']]
+
+maindarksfields = ['date:str', 'mjd:float', 'binning:int', 'exptime:float', 
+                   'path:str']
+maindarksindexes = [['binning', 'exptime']]
+
+mainflatsfields = ['date:str', 'mjd:float', 'filter:str', 'binning:int', 
+                   'path:str']
+mainflatsindexes = [['binning', 'filter']]
+
+# the persisted stack states (module_stack.StackState), one per target and
+# filter, on the grid of the reference frame (recno). stale: a frame in it
+# was reduced or aligned again, it must be rebuilt.
+stacksfields = ['target:str', 'filter:str', 'path:str', 'nframes:int',
+                'reference:int', 'stale:int']
+stacksindexes = [['target', 'filter']]
+
+# the intermediate products and the keys they were made with 
+# (module_cache.ProductCache):
+productsfields = ['product:str', 'stage:str', 'key:str']
     
 
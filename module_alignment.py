@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Alignment of the frames on a reference frame, with astroalign.
+
+astroalign.register does everything for every frame: detect the sources of
+both frames, compute the asterism invariants of both, match, warp. The
+reference is the same for all the frames, so here its control points and
+its invariant tree are computed once (ReferenceFrame) and every frame only
+pays for its own sources and the matching. The sources of each frame are
+kept in the database (sources column, as JSON) so that aligning again on
+another reference only redoes the matching.
+
+The matching is astroalign's own find_transform, with the reference half
+taken from the ReferenceFrame. It uses astroalign's internals
+(_generate_invariants, _MatchTransform, _ransac), written for
+astroalign 2.x.
+
+The frames are not warped here: the transform (in full frame coordinates)
+goes to the alignment column of the database, and the stacking warps each
+frame as it reads it (WarpedFrame), in float32, one tile of rows at a time.
+"""
+
+import json
+from pathlib import Path
+import numpy as np
+import astroalign as aa
+from scipy.spatial import KDTree
+from scipy.ndimage import affine_transform
+
+from module_trace import span, readSpan
+from skimage.transform import SimilarityTransform
+
+from module_fitsio import FitsFrame, writeFrame
+
+
+def detectSources(cropped, crop=0, max_control_points=50, detection_sigma=5,
+                  min_area=5):
+    """
+    the control points astroalign would use for cropped (a frame without
+    crop pixels on each side, FitsFrame.cropped), brightest first, in the
+    coordinates of the full (uncropped) frame.
+    """
+    points = aa._find_sources(aa._bw(np.asarray(cropped, dtype=np.float64)),
+                              detection_sigma=detection_sigma,
+                              min_area=min_area)[:max_control_points]
+    return np.reshape(points, (-1, 2)) + crop
+
+
+def sourcesToJSON(points, crop):
+    # the crop goes along: the points only are the same for the same crop.
+    return json.dumps({'crop':crop, 'points':np.round(points, 3).tolist()})
+
+
+def sourcesFromJSON(text, crop):
+    """
+    points stored by sourcesToJSON, or None if there are none or they were
+    detected with another crop.
+    """
+    if text is None:
+        return None
+    stored = json.loads(text)
+    if not stored['crop'] == crop:
+        return None
+    return np.reshape(np.array(stored['points'], dtype=np.float64), (-1, 2))
+
+
+class ReferenceFrame():
+    """
+    the control points, asterisms and invariant tree of the reference,
+    computed once. Built in the parent process before the pool is made, the
+    workers inherit it.
+    """
+    def __init__(self, points, crop=0):
+        # everything in the coordinates of the cropped frames, like
+        # register on cropped arrays:
+        self.crop = crop
+        self.points = np.asarray(points, dtype=np.float64) - crop
+        if len(self.points) < 3:
+            raise ValueError("Reference stars in target image are less "
+                             "than the minimum value (3).")
+        self.invariants, self.asterisms = \
+                                    aa._generate_invariants(self.points)
+        self.tree = KDTree(self.invariants)
+
+    def findTransform(self, points):
+        """
+        the SimilarityTransform mapping points (control points of a frame,
+        full frame coordinates) onto the reference, in cropped coordinates:
+        what astroalign.find_transform(cropped frame, cropped reference)
+        returns.
+        """
+        source = np.asarray(points, dtype=np.float64) - self.crop
+        if len(source) < 3:
+            raise ValueError("Reference stars in source image are less "
+                             "than the minimum value (3).")
+        invariants, asterisms = aa._generate_invariants(source)
+        tree = KDTree(invariants)
+        matches_list = tree.query_ball_tree(self.tree, r=0.1)
+        matches = []
+        for t1, t2_list in zip(asterisms, matches_list):
+            for t2 in self.asterisms[t2_list]:
+                matches.append(list(zip(t1, t2)))
+        matches = np.array(matches)
+
+        inv_model = aa._MatchTransform(source, self.points)
+        n_invariants = len(matches)
+        min_matches = max(1, min(10, int(n_invariants
+                                         * aa.MIN_MATCHES_FRACTION)))
+        if (len(source) == 3 or len(self.points) == 3) and len(matches) == 1:
+            best_t = inv_model.fit(matches)
+        else:
+            best_t, inlier_ind = aa._ransac(matches, inv_model, aa.PIXEL_TOL,
+                                            min_matches)
+        return best_t
+
+
+def _peakOffset(cm, c0, cp):
+    # subpixel position of a peak from three samples: gaussian (parabola
+    # in log), or parabola if the samples are not all positive.
+    if cm > 0 and c0 > 0 and cp > 0:
+        cm, c0, cp = np.log(cm), np.log(c0), np.log(cp)
+    denominator = cm - 2*c0 + cp
+    if denominator >= 0:
+        return 0.
+    return 0.5 * (cm - cp) / denominator
+
+
+class TranslationReference():
+    """
+    the frames of a tracked sequence are (almost always) only shifted
+    with respect to each other: the shift is the peak of the cross 
+    correlation with the reference, computed with FFTs in a few 
+    milliseconds. The frame and its quadrants are Hann windowed first. 
+    The spectra of the reference (whole and quadrants) are computed once.
+
+    findTranslation checks the result, and gives up (returns None) when
+        - the correlation peak is weak (normalised correlation < minpeak),
+        - the four quadrants do not agree on the shift within tolerance
+          pixels: there is some rotation or change of scale,
+    so that we can fall back to astroalign.
+    """
+    def __init__(self, cropped, crop=0, minpeak=0.2, tolerance=0.5):
+        """
+        cropped: the reference without crop pixels on each side.
+        """
+        self.crop = crop
+        self.minpeak = minpeak
+        self.tolerance = tolerance
+        self.windows = {}
+        ref = self._prepare(cropped)
+        self.shape = ref.shape
+        ny, nx = self.shape
+        self.quadrants = [(slice(0, ny//2), slice(0, nx//2)),
+                          (slice(0, ny//2), slice(nx//2, nx)),
+                          (slice(ny//2, ny), slice(0, nx//2)),
+                          (slice(ny//2, ny), slice(nx//2, nx))]
+        self.spectra = [self._spectrum(ref)] + \
+                       [self._spectrum(ref[q]) for q in self.quadrants]
+
+    def _prepare(self, cropped):
+        data = np.array(cropped, dtype=np.float32)
+        data -= np.median(data)
+        return data
+
+    def _window(self, shape):
+        # Hann windows, one per shape (the frame and its quadrants).
+        if shape not in self.windows:
+            ny, nx = shape
+            self.windows[shape] = np.outer(np.hanning(ny), 
+                                           np.hanning(nx)).astype(np.float32)
+        return self.windows[shape]
+
+    def _spectrum(self, data):
+        # the FFT is circular: without a window, the edges of the frame (or
+        # of a quadrant) correlate with the opposite ones and bias the peak.
+        # With the norm, for the normalised correlation.
+        data = data * self._window(data.shape)
+        return np.fft.rfft2(data), np.sqrt(np.sum(data.astype(np.float64)**2))
+
+    def _correlate(self, spectrum, refspectrum, shape):
+        """
+        (dx, dy, peak): the shift taking the frame onto the reference, and
+        the normalised correlation at the peak.
+        """
+        (frame, framenorm), (ref, refnorm) = spectrum, refspectrum
+        correlation = np.fft.irfft2(ref * np.conj(frame), s=shape)
+        correlation /= framenorm * refnorm
+        iy, ix = np.unravel_index(np.argmax(correlation), shape)
+        ny, nx = shape
+        dy = _peakOffset(correlation[(iy-1) % ny, ix], correlation[iy, ix],
+                         correlation[(iy+1) % ny, ix])
+        dx = _peakOffset(correlation[iy, (ix-1) % nx], correlation[iy, ix],
+                         correlation[iy, (ix+1) % nx])
+        # the correlation is circular: large shifts are negative ones.
+        iy = iy - ny if iy > ny // 2 else iy
+        ix = ix - nx if ix > nx // 2 else ix
+        return ix + dx, iy + dy, correlation[iy, ix]
+
+    def findTranslation(self, cropped):
+        """
+        the SimilarityTransform (a pure translation) mapping the frame
+        (cropped like the reference) onto the reference in cropped 
+        coordinates, like findTransform, or None if the frame is not just
+        shifted.
+        """
+        data = self._prepare(cropped)
+        if not data.shape == self.shape:
+            return None
+        dx, dy, peak = self._correlate(self._spectrum(data), self.spectra[0],
+                                       self.shape)
+        if not peak >= self.minpeak:
+            return None
+        for q, refspectrum in zip(self.quadrants, self.spectra[1:]):
+            qx, qy, qpeak = self._correlate(self._spectrum(data[q]), 
+                                            refspectrum, data[q].shape)
+            if np.hypot(qx - dx, qy - dy) > self.tolerance:
+                return None
+        return SimilarityTransform(translation=(dx, dy))
+
+
+def alignmentToJSON(transform, crop, fill, reference=None):
+    """
+    transform: what findTransform returns (cropped coordinates).
+    fill: the value given to the pixels coming from outside the frame (the
+          median of the frame, as astroalign.apply_transform does).
+    reference: recno of the reference frame.
+    The matrix is stored in full frame (x, y) coordinates, it does not 
+    depend on the crop.
+    """
+    shift = np.eye(3)
+    shift[:2, 2] = crop
+    unshift = np.eye(3)
+    unshift[:2, 2] = -crop
+    matrix = shift @ transform.params @ unshift
+    return json.dumps({'matrix':matrix.tolist(), 'fill':float(fill),
+                       'reference':reference})
+
+
+def alignmentReference(alignment):
+    # the recno of the reference frame of an alignment (JSON), if known.
+    if alignment is None:
+        return None
+    return json.loads(alignment).get('reference')
+
+
+class WarpedFrame():
+    """
+    a reduced frame seen through its alignment, read by tiles of rows like
+    FitsFrame (so that it can go straight to combineTiled): rows(r0, r1) 
+    reads the band of the frame that lands on rows r0 to r1 of the 
+    (cropped) reference, and interpolates it there in float32 (cubic 
+    spline, as astroalign.apply_transform).
+    """
+    # rows read beyond what the tile needs, so that the spline does not see
+    # the edge of the band:
+    margin = 16
+
+    def __init__(self, path, alignment, crop=0):
+        self.frame = FitsFrame(path)
+        self.crop = crop
+        alignment = json.loads(alignment)
+        self.fill = alignment['fill']
+        # output (x, y) in the reference -> (x, y) in the frame:
+        self.inverse = np.linalg.inv(np.array(alignment['matrix']))
+        ny, nx = self.frame.shape
+        self.shape = (ny - 2*crop, nx - 2*crop)
+        self.hasmask = False
+
+    def rows(self, r0, r1):
+        ny, nx = self.frame.shape
+        r1 = min(r1, self.shape[0])
+        crop = self.crop
+        # where the corners of the tile come from in the frame:
+        corners = np.array([[crop, crop+self.shape[1]-1, crop, 
+                             crop+self.shape[1]-1],
+                            [crop+r0, crop+r0, crop+r1-1, crop+r1-1],
+                            [1, 1, 1, 1]])
+        sourcey = (self.inverse @ corners)[1]
+        y0 = max(0, int(np.floor(sourcey.min())) - self.margin)
+        y1 = min(ny, int(np.ceil(sourcey.max())) + self.margin + 1)
+        if y0 >= y1:
+            # entirely outside of the frame.
+            return np.full((r1-r0, self.shape[1]), self.fill, 
+                           dtype=np.float32), None
+        data, _ = self.frame.rows(y0, y1)
+        data = np.asarray(data, dtype=np.float32)
+        # affine_transform works in (row, column): output (i, j) of the 
+        # tile is (x, y) = (j + crop, i + r0 + crop) in the reference,
+        # row y - y0 and column x of the band.
+        a, t = self.inverse[:2, :2], self.inverse[:2, 2]
+        matrix = np.array([[a[1, 1], a[1, 0]],
+                           [a[0, 1], a[0, 0]]])
+        offset = [a[1, 0]*crop + a[1, 1]*(r0+crop) + t[1] - y0,
+                  a[0, 0]*crop + a[0, 1]*(r0+crop) + t[0]]
+        warped = affine_transform(data, matrix, offset=offset,
+                                  output_shape=(r1-r0, self.shape[1]),
+                                  output=np.float32, order=3, 
+                                  mode='grid-constant', cval=self.fill)
+        return warped, None
+
+    def close(self):
+        self.frame.close()
+
+
+def alignmentProduct(reducedpath):
+    # the name of the alignment of a frame, for the ProductCache.
+    return f"{reducedpath}#alignment"
+
+
+def alignmentExists(image, alignedpath=None):
+    # whether the alignment of image (database entry) is still there.
+    if image['alignment'] is None:
+        return False
+    return alignedpath is None or Path(alignedpath).exists()
+
+
+def chooseReference(images):
+    """
+    the reference of the previous runs if it is still among images (the
+    persisted stacks are on its grid), else the frame in the middle.
+    """
+    byrecno = {image['recno']:image for image in images}
+    previous = [alignmentReference(image['alignment']) for image in images]
+    previous = [recno for recno in previous if recno in byrecno]
+    if len(previous) > 0:
+        return byrecno[max(set(previous), key=previous.count)]
+    return images[len(images)//2]
+
+
+# the references of this process, built once per reference frame (the pool
+# workers inherit those built before the pool is made):
+_references = {}
+
+def referencesFor(refpath, refpoints=None, crop=0, engine='auto'):
+    """
+    the ReferenceFrame (and TranslationReference with the 'auto' engine)
+    of the reference frame at refpath. Its sources are detected if refpoints
+    is None.
+    """
+    key = (str(refpath), crop, engine)
+    if not key in _references:
+        # (only the pixels within the crop are read)
+        with FitsFrame(refpath) as frame:
+            cropped = frame.cropped(crop)
+        if refpoints is None:
+            refpoints = detectSources(cropped, crop=crop)
+        translation = None
+        if engine == 'auto':
+            translation = TranslationReference(cropped, crop=crop)
+        _references[key] = (ReferenceFrame(refpoints, crop=crop), translation)
+    return _references[key]
+
+
+def alignFrame(path, sources, refpath, refsources, refrecno, crop=0,
+               engine='auto', alignedpath=None, compression=None):
+    """
+    the transform of the reduced frame at path onto the reference.
+    sources, refsources: the JSON of the sources of the frame and of the
+                         reference, if we have them (else None).
+    engine: 'auto' (cross correlation if the frame is only shifted,
+            astroalign otherwise) or 'astroalign'.
+    alignedpath: if given, the aligned frame is written there (with
+                 compression, see module_fitsio).
+    Returns the JSON of the alignment, the JSON of the sources of the frame
+    if they were detected here (else None), and the engine that was used
+    ('fft' or 'astroalign').
+    """
+    reference, translation = referencesFor(refpath,
+                                           sourcesFromJSON(refsources, crop),
+                                           crop, engine)
+    # only the pixels within the crop are read:
+    with readSpan(path), FitsFrame(path) as frame:
+        cropped = frame.cropped(crop)
+
+    transform, newsources, used = None, None, 'astroalign'
+    if translation is not None:
+        # a simple shift, found by cross correlation?
+        with span('fft'):
+            transform = translation.findTranslation(cropped)
+        used = 'fft'
+    if transform is None:
+        # no: rotation, scale or weak correlation, we match asterisms.
+        points = sourcesFromJSON(sources, crop)
+        if points is None:
+            with span('sources'):
+                points = detectSources(cropped, crop=crop)
+            newsources = sourcesToJSON(points, crop)
+        with span('astroalign'):
+            transform = reference.findTransform(points)
+        used = 'astroalign'
+    # (the pixels coming from outside the frame get its median, like
+    # astroalign.apply_transform does)
+    alignment = alignmentToJSON(transform, crop, np.median(cropped), refrecno)
+
+    if alignedpath is not None:
+        with span('write', path=alignedpath):
+            frame = WarpedFrame(path, alignment, crop=crop)
+            aligned, _ = frame.rows(0, frame.shape[0])
+            frame.close()
+            writeFrame(alignedpath, aligned, compression=compression)
+    return alignment, newsources, used
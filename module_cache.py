@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Which intermediate products are still up to date, so that a rerun (after a
+crash, or after adding a few frames) only makes what changed.
+
+Each product (a main calibration, a reduced frame, an alignment ...) is
+recorded in the 'products' table of the database with a key: a hash of
+the stage, of the identities of its inputs, and of the parameters of the
+stage. The identity of an input is its own key if it is a product (so a
+rebuilt main bias changes the key of everything made from it, in the same
+run), else its size and modification time (raw frames).
+
+    with ProductCache(db) as cache:
+        if not cache.check(writepath, 'reduce', [rawpath, biaspath], 
+                           engine=engine):
+            ... make writepath ...
+            cache.done(writepath)
+    print(cache.report())
+
+(what was made is written to the database on the way out of the with
+block, even if something failed in between)
+"""
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from database import productsfields
+
+
+class ProductCache():
+    def __init__(self, db, enabled=True, batchsize=100, tablename='products'):
+        """
+        enabled: if False nothing is considered up to date, but the keys of
+                 what is made are still recorded for the next run.
+        """
+        self.db = db
+        self.enabled = enabled
+        self.batchsize = batchsize
+        self.tablename = tablename
+        db.create(productsfields, tablename=tablename)
+        db.setUnique('product', tablename=tablename)
+        # product -> key, as recorded by the previous runs:
+        self.stored = dict(db.execute(f"select product, key from {tablename}"))
+        # product -> (stage, key) of this run:
+        self.current = {}
+        # the products to make (checked, not up to date), and those made
+        # but not written to the database yet:
+        self.missed = set()
+        self.pending = []
+        # stage -> [hits, misses]
+        self.counts = {}
+
+    def identity(self, path):
+        path = str(path)
+        if path in self.current:
+            return self.current[path][1]
+        if path in self.stored:
+            return self.stored[path]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime]
+
+    def key(self, stage, inputs, **params):
+        identities = [[str(path), self.identity(path)] for path in inputs]
+        text = json.dumps([stage, identities, params], sort_keys=True,
+                          default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def check(self, product, stage, inputs, exists=None, **params):
+        """
+        True if product is up to date: same key as when it was made and
+        still there (exists: whether it is there, by default whether the
+        file product exists).
+        """
+        product = str(product)
+        key = self.key(stage, inputs, **params)
+        self.current[product] = (stage, key)
+        if exists is None:
+            exists = Path(product).exists()
+        hit = self.enabled and exists and self.stored.get(product) == key
+        counts = self.counts.setdefault(stage, [0, 0])
+        counts[0 if hit else 1] += 1
+        if not hit:
+            self.missed.add(product)
+        return hit
+
+    def done(self, product):
+        """
+        product was made (products that were not checked are ignored).
+        """
+        product = str(product)
+        if not product in self.missed:
+            return
+        self.missed.discard(product)
+        stage, key = self.current[product]
+        self.pending.append((product, stage, key))
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.db.executeMany([(f"insert or replace into {self.tablename} "
+                              f"(product, stage, key) values (?, ?, ?)",
+                              self.pending)])
+        for product, _, key in self.pending:
+            self.stored[product] = key
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def report(self):
+        return '\n'.join(f"{stage}: {hits} up to date, {misses} to make"
+                         for stage, (hits, misses) in self.counts.items())
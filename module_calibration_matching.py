@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Finding the main calibration (bias, dark, flat) closest in time to a frame.
+
+For each (table, binning, filter, exptime ...) combination we query the
+database once, keep the mjd column as a sorted array and answer the
+"closest calibration" questions with a binary search.
+"""
+
+import numpy as np
+
+
+class CalibrationMatcher():
+    def __init__(self, db):
+        self.db = db
+        # (table, (field, value), ...) -> (sorted mjds, entries)
+        self.index = {}
+        # calibrations not in the database yet, but that will be made:
+        self.planned = {}
+
+    def _key(self, tablename, keys):
+        return (tablename,) + tuple(sorted(keys.items()))
+
+    def _build(self, tablename, keys):
+        fields = list(keys.keys())
+        searchdata = list(keys.values())
+        if len(fields) == 0:
+            fields, searchdata = ['recno'], ['*']
+        entries = self.db.select(fields, searchdata, tablename=tablename,
+                                 sortFields=['mjd'], returnType='dict')
+        planned = [e for e in self.planned.get(tablename, []) 
+                    if all(e[k] == v for k, v in keys.items())]
+        if len(planned) > 0:
+            # a planned calibration replaces the one with the same path.
+            plannedpaths = set(str(e['path']) for e in planned)
+            entries = [e for e in entries 
+                         if not str(e['path']) in plannedpaths] + planned
+            entries = sorted(entries, key=lambda e: e['mjd'])
+        entries = [e for e in entries if e['mjd'] is not None]
+        mjds = np.array([e['mjd'] for e in entries], dtype=float)
+        return mjds, entries
+
+    def addPlanned(self, tablename, entries):
+        """
+        calibrations that are not in the database yet (e.g. that are about to
+        be made), but should be considered by closest.
+        """
+        self.planned.setdefault(tablename, []).extend(entries)
+        self.invalidate(tablename)
+
+    def invalidate(self, tablename=None):
+        """
+        to be called when new calibrations were added to the database.
+        """
+        if tablename is None:
+            self.index = {}
+        else:
+            self.index = {k:v for k, v in self.index.items()
+                                                    if not k[0] == tablename}
+
+    def closest(self, tablename, mjd, **keys):
+        """
+        returns the entry (dictionary) of tablename closest in time to mjd,
+        among those matching keys, e.g.
+
+            matcher.closest('mainflats', 59696.9, binning=3, filter='R')
+        """
+        key = self._key(tablename, keys)
+        if not key in self.index:
+            self.index[key] = self._build(tablename, keys)
+        mjds, entries = self.index[key]
+        if len(mjds) == 0:
+            raise LookupError(f"No calibration in {tablename} for {keys}")
+        i = np.searchsorted(mjds, mjd)
+        # the closest one is either just before or just after.
+        if i == len(mjds):
+            i -= 1
+        elif i > 0 and mjd - mjds[i-1] <= mjds[i] - mjd:
+            i -= 1
+        return entries[i]
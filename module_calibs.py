@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The tasks making the main calibrations, run by the pool of
+2_make_main_calibs.py. Everything they need comes as arguments (paths,
+exposure times), they do not touch the database.
+"""
+
+from ccdproc import subtract_bias, subtract_dark
+from astropy.units import s
+from astropy.io import fits
+
+from module_combine import combine
+from module_fitsio import writeFrame, readCCD
+from module_remove_stars_flats import removeStarsFromArray, starMaskFromArray
+from module_trace import span, readSpan
+
+
+def makeMain(files, path, engine='tiled', memorybudget=2e9, variance=False,
+             compression=None):
+    """
+    sigma clipped average of files, written to path (see module_fitsio for
+    compression), with its variance if asked for. Pixels masked in all
+    the files (a star at the same place in every flat) are not lost, the
+    masks are ignored there.
+    """
+    av = combine(files, engine=engine, memorybudget=memorybudget,
+                 unmaskifall=True)
+    var = None
+    if variance and av.uncertainty is not None:
+        var = av.uncertainty.array**2
+    header = fits.Header()
+    header['NCOMBINE'] = av.meta.get('NCOMBINE', len(files))
+    with span('write', path=path):
+        writeFrame(path, av.data, var, header=header, compression=compression)
+    return path
+
+
+def reduceDark(path, biaspath, writepath, compression=None):
+    with readSpan(path):
+        biasccd = readCCD(biaspath)
+        darkccd = readCCD(path)
+    with span('ccdproc'):
+        reddark = subtract_bias(darkccd, biasccd)
+    with span('write', path=writepath):
+        writeFrame(writepath, reddark.data, compression=compression)
+    return writepath
+
+
+def reduceFlat(path, exptime, biaspath, darkpath, darkexptime, writepath,
+               starremoval='fit', moffatfitter='batched', compression=None):
+    """
+    starremoval: 'mask' (the stars are masked, the combination leaves them
+                 out) or 'fit' (a Moffat profile is fitted and subtracted for
+                 each star, with moffatfitter).
+    """
+    with readSpan(path):
+        biasccd = readCCD(biaspath)
+        darkccd = readCCD(darkpath)
+        flatccd = readCCD(path)
+    with span('ccdproc'):
+        redflat1 = subtract_bias(flatccd, biasccd)
+        redflat = subtract_dark(redflat1, darkccd,
+                                dark_exposure=darkexptime*s,
+                                data_exposure=exptime*s)
+    # mask or remove potential stars from the flat:
+    with span('stars', mode=starremoval):
+        if starremoval == 'mask':
+            redflat.mask = starMaskFromArray(redflat.data)
+        else:
+            redflat.data = removeStarsFromArray(redflat.data,
+                                                mode=moffatfitter)
+    with span('write', path=writepath):
+        writeFrame(writepath, redflat.data, mask=redflat.mask,
+                   compression=compression)
+    return writepath
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sigma clipped average combination of frames, for the main calibrations and
+the stacks.
+
+ccdproc's Combiner loads all the frames in one float64 cube (plus a mask),
+which does not fit in memory for a hundred full frames. combineTiled gives
+the same result -- clipping around the median at low_thresh/high_thresh
+standard deviations (one iteration), then average of what is left --
+but goes through the frames by tiles of rows: only a
+(number of frames) x (rows in a tile) x (columns) cube is in memory at once,
+the tile size being set by a memory budget. The fits files are memory-mapped
+(FitsFrame) and only the rows of the current tile are read.
+"""
+
+import numpy as np
+from astropy.nddata import StdDevUncertainty
+from astropy.stats import sigma_clip
+from ccdproc import CCDData, Combiner
+
+from module_trace import span
+from module_fitsio import FitsFrame, readCCD
+
+
+def _meanOfFrame(frame, rowsper):
+    # mean of the unmasked pixels, going through the frame by tiles as well.
+    total, count = 0., 0
+    for r0 in range(0, frame.shape[0], rowsper):
+        data, mask = frame.rows(r0, r0+rowsper)
+        data = np.asarray(data, dtype=np.float64)
+        good = np.isfinite(data)
+        if mask is not None:
+            good &= ~mask
+        total += np.sum(data[good])
+        count += np.count_nonzero(good)
+    return total / count
+
+
+def combineRows(frames, low_thresh=2, high_thresh=4, scaling=None,
+                memorybudget=2e9, unmaskifall=False):
+    """
+    the actual work of combineTiled, see there. Returns plain arrays:
+    mean, standard deviation and number of frames used, for each pixel.
+    """
+    n = len(frames)
+    ny, nx = frames[0].shape
+    for frame in frames:
+        if not tuple(frame.shape) == (ny, nx):
+            raise TypeError("The frames are not the same size.")
+    # per pixel of the cube: the float64 data, a float64 copy for the median
+    # and the deviations, and the masks.
+    rowsper = int(memorybudget // (n * nx * 20))
+    rowsper = max(1, min(ny, rowsper))
+
+    if isinstance(scaling, str) and scaling == 'mean':
+        # like Combiner.scaling = lambda arr: 1/np.ma.average(arr)
+        scaling = [1/_meanOfFrame(frame, rowsper) for frame in frames]
+    if scaling is not None:
+        scaling = np.asarray(scaling, dtype=np.float64)[:, None, None]
+
+    mean = np.empty((ny, nx), dtype=np.float64)
+    std = np.empty((ny, nx), dtype=np.float64)
+    count = np.empty((ny, nx), dtype=np.int32)
+    for r0 in range(0, ny, rowsper):
+        r1 = min(ny, r0+rowsper)
+        cube = np.empty((n, r1-r0, nx), dtype=np.float64)
+        inmask = np.zeros(cube.shape, dtype=bool)
+        for i, frame in enumerate(frames):
+            data, mask = frame.rows(r0, r1)
+            cube[i] = data
+            if mask is not None:
+                inmask[i] = mask
+        # the clipping, as astropy's sigma_clip does it for ccdproc:
+        # on all the data (masked or not), one iteration.
+        if np.isnan(cube).any():
+            center = np.nanmedian(cube, axis=0)
+            dev = np.nanstd(cube, axis=0)
+        else:
+            center = np.median(cube, axis=0)
+            dev = np.std(cube, axis=0)
+        with np.errstate(invalid='ignore'):
+            rejected = (cube < center - low_thresh*dev) | \
+                       (cube > center + high_thresh*dev)
+        rejected |= np.isnan(cube)
+        if unmaskifall:
+            # pixels masked in every frame: we use them anyway.
+            allmasked = np.all(rejected | inmask, axis=0) & \
+                        ~np.all(rejected, axis=0)
+            inmask[:, allmasked] = False
+        rejected |= inmask
+        if scaling is not None:
+            cube *= scaling
+        cube[rejected] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[r0:r1] = np.nanmean(cube, axis=0)
+            std[r0:r1] = np.nanstd(cube, axis=0)
+        count[r0:r1] = n - rejected.sum(axis=0)
+    return mean, std, count
+
+
+def combineTiled(paths, low_thresh=2, high_thresh=4, scaling=None,
+                 memorybudget=2e9, unmaskifall=False):
+    """
+    paths: list of fits files, or of objects with a shape attribute and a
+           rows(r0, r1) method returning (data, mask) like FitsFrame.
+    scaling: None, 'mean' (each frame multiplied by the inverse of its mean
+             before averaging) or a list of factors, one per frame.
+    memorybudget: bytes we allow for the tile cube.
+    unmaskifall: where a pixel is masked (or clipped) in every frame, 
+                 ignore the masks (e.g. a star masked in every flat) 
+                 instead of returning a masked NaN.
+
+    returns a CCDData, like Combiner.average_combine: the clipped mean, its
+    uncertainty (standard deviation / sqrt(number of frames used)) and a
+    mask of the pixels where every frame was rejected.
+    """
+    frames = [FitsFrame(p) if not hasattr(p, 'rows') else p for p in paths]
+    try:
+        mean, std, count = combineRows(frames, low_thresh=low_thresh,
+                                       high_thresh=high_thresh,
+                                       scaling=scaling,
+                                       memorybudget=memorybudget,
+                                       unmaskifall=unmaskifall)
+    finally:
+        for frame in frames:
+            if isinstance(frame, FitsFrame):
+                frame.close()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        uncertainty = std / np.sqrt(count)
+    combined = CCDData(mean, unit='adu', mask=(count == 0),
+                       uncertainty=StdDevUncertainty(uncertainty))
+    combined.meta['NCOMBINE'] = len(frames)
+    return combined
+
+
+def _readCCD(path):
+    # a whole frame, from a fits file or an object with rows (FitsFrame...)
+    if hasattr(path, 'rows'):
+        data, mask = path.rows(0, path.shape[0])
+        return CCDData(np.asarray(data), mask=mask, unit='adu')
+    return readCCD(str(path))
+
+
+def combineCCDProc(paths, low_thresh=2, high_thresh=4, scaling=None,
+                   unmaskifall=False):
+    """
+    the reference: ccdproc's Combiner, everything in memory.
+    """
+    ccds = [_readCCD(p) for p in paths]
+    cmb = Combiner(ccds)
+    if isinstance(scaling, str) and scaling == 'mean':
+        cmb.scaling = lambda arr: 1/np.ma.average(arr)
+    elif scaling is not None:
+        cmb.scaling = scaling
+    inmask = np.array(cmb.data_arr.mask)
+    cmb.sigma_clipping(low_thresh=low_thresh, high_thresh=high_thresh,
+                       func=np.ma.median)
+    if unmaskifall:
+        # as combineRows: where every frame is masked or rejected, but not 
+        # every one rejected, the masks are ignored.
+        rejected = sigma_clip(cmb.data_arr.data, sigma_lower=low_thresh,
+                              sigma_upper=high_thresh, axis=0, maxiters=1,
+                              cenfunc=np.ma.median, masked=True).mask
+        allmasked = np.all(rejected | inmask, axis=0) & \
+                    ~np.all(rejected, axis=0)
+        cmb.data_arr.mask[:, allmasked] = rejected[:, allmasked]
+    return cmb.average_combine()
+
+
+def checkCombineAgainstCCDProc(paths, tolerance=1e-6, **kwargs):
+    """
+    combines the frames both ways (kwargs: those of combineTiled) and 
+    compares. Returns the largest difference relative to the dynamic range
+    of the combined frame, raises an AssertionError if it is above 
+    tolerance or if the masks differ.
+    """
+    reference = combineCCDProc(paths, **{k:v for k, v in kwargs.items() 
+                                         if not k == 'memorybudget'})
+    tiled = combineTiled(paths, **kwargs)
+
+    refmask = np.zeros(reference.shape, dtype=bool) \
+                  if reference.mask is None else reference.mask
+    if not np.array_equal(tiled.mask, refmask):
+        raise AssertionError(f"tiled combination masks "
+                             f"{np.count_nonzero(tiled.mask != refmask)} "
+                             f"pixels differently from ccdproc")
+    good = ~refmask
+    scale = np.max(np.abs(reference.data[good]))
+    difference = np.max(np.abs(tiled.data[good] - reference.data[good])) \
+                 / scale
+    if difference > tolerance:
+        raise AssertionError(f"tiled combination differs from ccdproc by "
+                             f"{difference:.2e} (relative), more than "
+                             f"{tolerance:.0e}")
+    return difference
+
+
+def combine(paths, engine='tiled', low_thresh=2, high_thresh=4,
+            scaling=None, memorybudget=2e9, unmaskifall=False):
+    """
+    engine: 'tiled' (combineTiled) or 'ccdproc' (combineCCDProc)
+    """
+    with span('combine', engine=engine, frames=len(paths)):
+        if engine == 'ccdproc':
+            return combineCCDProc(paths, low_thresh=low_thresh,
+                                  high_thresh=high_thresh, scaling=scaling,
+                                  unmaskifall=unmaskifall)
+        return combineTiled(paths, low_thresh=low_thresh,
+                            high_thresh=high_thresh, scaling=scaling,
+                            memorybudget=memorybudget,
+                            unmaskifall=unmaskifall)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+How the intermediate products (main calibrations, reduced darks and flats,
+reduced and aligned frames) are written and read back.
+
+CCDData.write saves the data in float64, plus an uncertainty and a mask
+extension, whatever is needed afterwards. writeFrame saves the data in
+float32, and only the extensions asked for:
+    - VARIANCE (float32): the variance of the data, when the
+      uncertainties are propagated (reductionvariance);
+    - MASK (uint8): the masked pixels, for the reduced flats in 'mask' mode.
+The HDUs can also be tile compressed (compression: 'RICE_1', 'GZIP_1' or
+'GZIP_2'). With RICE_1 the floats are quantized to 16 levels per standard
+deviation of the noise (astropy's default): about four times smaller than
+float32, lossy but far below the noise. The GZIP ones are lossless (no
+quantization), and gain less on noisy frames. The data of a compressed
+file is in its first extension, the primary HDU is empty.
+
+The final products (the stacks) are not written here, they stay plain
+fits images.
+
+FitsFrame reads them (and the raw frames) memory-mapped, by sections: only
+the pixels asked for are read and converted, not the whole frame.
+"""
+
+import numpy as np
+from astropy.io import fits
+from ccdproc import CCDData
+
+
+def _imageHDU(data, name=None, header=None, compression=None, quantize=None):
+    if compression is None:
+        return fits.ImageHDU(data, header=header, name=name)
+    if quantize is None:
+        quantize = 0 if compression.startswith('GZIP') else 16
+    return fits.CompImageHDU(data, header=header, name=name,
+                             compression_type=compression,
+                             quantize_level=quantize)
+
+
+def writeFrame(path, data, variance=None, mask=None, header=None,
+               compression=None, quantize=None):
+    """
+    data (and variance) as float32, mask as uint8, see above. quantize: to
+    quantize differently from the default of the compression.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if compression is None:
+        hdus = [fits.PrimaryHDU(data, header=header)]
+    else:
+        hdus = [fits.PrimaryHDU(),
+                _imageHDU(data, header=header, compression=compression,
+                          quantize=quantize)]
+    if variance is not None:
+        hdus.append(_imageHDU(np.asarray(variance, dtype=np.float32),
+                              'VARIANCE', compression=compression,
+                              quantize=quantize))
+    if mask is not None:
+        # (integers are compressed without loss)
+        hdus.append(_imageHDU(np.asarray(mask, dtype=np.uint8), 'MASK',
+                              compression=compression))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+    return path
+
+
+def dataIndex(hdul):
+    # the first HDU with data: the primary one, or the first extension of a
+    # compressed file.
+    for i, hdu in enumerate(hdul):
+        if hdu.header.get('NAXIS', 0) > 0:
+            return i
+    raise ValueError(f"no data in {hdul.filename()}")
+
+
+class FitsFrame():
+    """
+    a frame on disk, opened memory-mapped: nothing is read until asked for,
+    and then only the pixels asked for (for a compressed frame, only the
+    tiles they are in are decompressed).
+        frame.shape
+        frame.section(y0, y1, x0, x1)   a region, as stored (dtype None)
+                                        or converted to dtype
+        frame.cropped(crop)             the frame without crop pixels on
+                                        each side
+        frame.rows(r0, r1)              data, mask of a band of rows (mask
+                                        is None if there is no MASK
+                                        extension), what combineTiled and
+                                        reduceRows go through
+    Integer frames with BZERO/BSCALE (the raw frames, unsigned 16 bits)
+    cannot be memory-mapped by astropy, which would read and scale the
+    whole frame: here only the section is scaled, to float32.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.hdul = fits.open(self.path, memmap=True,
+                              do_not_scale_image_data=True)
+        self.hdu = self.hdul[dataIndex(self.hdul)]
+        self.shape = self.hdu.shape
+        self.hasmask = 'MASK' in self.hdul
+        self.bscale = self.hdu.header.get('BSCALE', 1)
+        self.bzero = self.hdu.header.get('BZERO', 0)
+
+    def _scaled(self, data):
+        if self.bscale == 1 and self.bzero == 0:
+            return data
+        scaled = np.multiply(data, self.bscale, dtype=np.float32)
+        scaled += self.bzero
+        return scaled
+
+    def section(self, y0=0, y1=None, x0=0, x1=None, dtype=None):
+        data = self._scaled(self.hdu.section[y0:y1, x0:x1])
+        if dtype is None:
+            return data
+        return np.asarray(data, dtype=dtype)
+
+    def cropped(self, crop=0, dtype=np.float32):
+        ny, nx = self.shape
+        return self.section(crop, ny-crop, crop, nx-crop, dtype=dtype)
+
+    def rows(self, r0, r1):
+        data = self._scaled(self.hdu.section[r0:r1])
+        mask = None
+        if self.hasmask:
+            mask = self.hdul['MASK'].section[r0:r1].astype(bool)
+        return data, mask
+
+    def close(self):
+        self.hdul.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def readFrame(path, variance=False):
+    """
+    returns the data of a frame, and its variance (None if not asked for
+    or not there). The variance of the files written by CCDData.write
+    (UNCERT extension, standard deviations) is read as well.
+    """
+    with fits.open(path) as hdul:
+        data = hdul[dataIndex(hdul)].data
+        var = None
+        if variance and 'VARIANCE' in hdul:
+            var = hdul['VARIANCE'].data
+        elif variance and 'UNCERT' in hdul:
+            var = hdul['UNCERT'].data.astype(np.float32)**2
+    return data, var
+
+
+def readCCD(path):
+    """
+    a frame as a CCDData (in adu), with its mask if it has one.
+    """
+    with fits.open(path) as hdul:
+        data = hdul[dataIndex(hdul)].data
+        mask = None
+        if 'MASK' in hdul:
+            mask = hdul['MASK'].data.astype(bool)
+    return CCDData(data, mask=mask, unit='adu')
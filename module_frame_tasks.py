@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The tasks run on the science frames by run_pipeline.py (the stage by stage
+scripts have their own loops). Like module_calibs, everything they need
+comes as arguments (paths, exposure times), they do not touch the database.
+"""
+
+import numpy as np
+from astropy.io import fits
+
+from module_reduction import calibrationTerms, reduceRows, reduceCCDProc
+from module_fitsio import FitsFrame, readFrame, writeFrame
+from module_trace import span, readSpan
+
+
+def makeCalibrationTerms(biaspath, darkpath, flatpath, darkscale, prefix,
+                         variance=False):
+    """
+    the terms of reduceFast for these calibrations, saved as .npy files
+    (prefix_offset.npy, ...) that the reductions memory-map: the workers
+    share them through the page cache. Returns their paths.
+    """
+    bias, biasvar = readFrame(biaspath, variance)
+    dark, darkvar = readFrame(darkpath, variance)
+    flat, flatvar = readFrame(flatpath, variance)
+    terms = calibrationTerms(bias, dark, flat, darkscale,
+                             biasvar, darkvar, flatvar)
+    paths = []
+    for name, term in zip(['offset', 'invflat', 'offsetvar', 'flatrelvar'],
+                          terms):
+        path = f"{prefix}_{name}.npy"
+        np.save(path, term)
+        paths.append(path)
+    return paths
+
+
+def reduceFrame(path, writepath, terms, compression=None):
+    """
+    terms: the paths returned by makeCalibrationTerms.
+    compression: of the reduced frame (see module_fitsio).
+    """
+    terms = [np.load(p, mmap_mode='r') for p in terms]
+    variance = None
+    # (the raw frame is read band by band, as it is reduced)
+    with readSpan(path), span('reduce'), FitsFrame(path) as raw:
+        if len(terms) > 2:
+            redimg, variance = reduceRows(raw, *terms)
+        else:
+            redimg = reduceRows(raw, *terms)
+    with span('write', path=writepath):
+        writeFrame(writepath, redimg, variance, compression=compression)
+    return writepath
+
+
+def reduceFrameCCDProc(path, writepath, biaspath, darkpath, flatpath,
+                       darkexptime, exptime, scaledark=False,
+                       compression=None):
+    with readSpan(path):
+        arrays = [fits.getdata(p) for p in [path, biaspath, darkpath,
+                                            flatpath]]
+    with span('ccdproc'):
+        redimg = reduceCCDProc(*arrays, darkexptime, exptime,
+                               scaledark=scaledark)
+    with span('write', path=writepath):
+        writeFrame(writepath, redimg, compression=compression)
+    return writepath
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Adding the fits files of datadir to the database (1_add_images.py, and the
+first step of run_pipeline.py).
+
+Only the files that are new or changed since the last scan (size, 
+modification time) have their header read, by a pool of threads, and 
+everything goes to the database in a few transactions.
+"""
+import os
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from astropy.io import fits
+from astropy.time import Time
+
+from module_nights import nightOf
+from module_trace import span
+from module_stack import markForRebuild
+
+
+def scanFiles(topdir, excludeddirs=set()):
+    """
+    walks topdir and yields (path, size, mtime) of every fits file,
+    without descending into the excluded directories at all.
+    """
+    for root, dirs, files in os.walk(topdir):
+        dirs[:] = [d for d in dirs 
+                     if not str(Path(root, d).resolve()) in excludeddirs]
+        for name in files:
+            if not name.endswith('.fits'):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            yield path, stat.st_size, stat.st_mtime
+
+
+def readImage(fileinfo):
+    # Header.fromfile only reads the primary header blocks (up to the END
+    # card), the data is never touched. Cheap and I/O bound, so threads are
+    # fine here.
+    imagepath, size, mtime = fileinfo
+    try:
+        with span('header', path=imagepath):
+            hdr = fits.Header.fromfile(imagepath)
+        return {'path':imagepath,
+                'imagetyp':hdr['imagetyp'],
+                'exptime':hdr['exptime'],
+                'binning':hdr['xbinning'],
+                'airmass':hdr['airmass'],
+                'object':hdr['object'],
+                'focpos':hdr['focpos'],
+                'filter':hdr['filter'],
+                'dateobs':hdr['date-obs'],
+                'ccdtemp':hdr['ccd-temp'],
+                'filesize':size,
+                'filemtime':mtime}
+    except Exception as e:
+        print(f"Problem with image {imagepath}: {e}")
+        return None
+
+
+def ingest(db, datadir, excludeddirs=[], threads=16, utcoffset=1):
+    """
+    datadir: scanned recursively, except for excludeddirs (our own products
+             can live inside datadir).
+    returns the number of files scanned, added and updated, and the time
+    it took.
+    """
+    excludeddirs = set(str(Path(d).resolve()) for d in excludeddirs)
+    t0 = time.time()
+
+    # what we already know: path -> (recno, size, mtime), and the row
+    known = db.select(['recno'], ['*'], 
+                      filter=['path', 'recno', 'filesize', 'filemtime', 
+                              'object', 'filter', 'stacked'], 
+                      returnType='dict')
+    rows = {e['path']:e for e in known}
+    known = {e['path']:(e['recno'], e['filesize'], e['filemtime']) 
+                                                            for e in known}
+
+    newfiles, changedfiles = [], []
+    nscanned = 0
+    with span('scan', datadir=datadir):
+        for path, size, mtime in scanFiles(datadir, excludeddirs):
+            nscanned += 1
+            if path in known:
+                recno, oldsize, oldmtime = known[path]
+                if oldsize == size and oldmtime == mtime:
+                    # unchanged, nothing to do.
+                    continue
+                changedfiles.append((path, size, mtime))
+            else:
+                newfiles.append((path, size, mtime))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        newentries = [e for e in executor.map(readImage, newfiles) 
+                                                              if e is not None]
+        changedentries = [e for e in executor.map(readImage, changedfiles) 
+                                                              if e is not None]
+
+    # the dates as mjds, all at once (one Time object for everything):
+    newmjds = Time([e['dateobs'] for e in newentries + changedentries],
+                   format='isot', scale='utc').to_value('mjd')
+    newnights = nightOf(newmjds, utcoffset)
+    for entry, mjd, night in zip(newentries + changedentries, newmjds, 
+                                 newnights):
+        entry['mjd'] = float(mjd)
+        entry['night'] = night
+
+    # all the new rows in one transaction:
+    db.insertBatch(newentries)
+    # files that were modified since the last scan keep their row, but what
+    # was made from the old version is done again by the next stages (and
+    # the incremental stacks it is in are rebuilt):
+    markForRebuild(db, [rows[entry['path']] for entry in changedentries])
+    for entry in changedentries:
+        entry.update({'reducedpath':None, 'sources':None, 'alignment':None,
+                      'stacked':0})
+    db.updateBatch(['recno'], 
+                   [[known[entry['path']][0]] for entry in changedentries],
+                   changedentries)
+
+    # rows ingested before we had an mjd column:
+    missing = db.execute("select recno, dateobs from images "
+                         "where mjd is null and dateobs is not null")
+    if len(missing) > 0:
+        mjds = Time([dateobs for _, dateobs in missing], 
+                    format='isot', scale='utc').to_value('mjd')
+        db.updateBatch(['recno'], [[recno] for recno, _ in missing],
+                       [{'mjd':float(mjd)} for mjd in mjds])
+
+    # and before we had a night column:
+    missing = db.execute("select recno, mjd from images "
+                         "where night is null and mjd is not null")
+    if len(missing) > 0:
+        nights = nightOf([mjd for _, mjd in missing], utcoffset)
+        db.updateBatch(['recno'], [[recno] for recno, _ in missing],
+                       [{'night':night} for night in nights])
+
+    dt = time.time() - t0
+    return nscanned, len(newentries), len(changedentries), dt
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Which observing night does a frame belong to?
+
+A night goes from local noon to the next local noon, and is named after the
+date of its evening (YYYY-MM-DD). Computed once at ingestion and stored in
+the night column of the database, so that grouping frames by night is a
+simple (indexed) query.
+"""
+
+import datetime
+import numpy as np
+
+# MJD 0:
+mjdorigin = datetime.date(1858, 11, 17)
+
+
+def nightOf(mjd, utcoffset=1):
+    """
+    mjd: modified julian date (UTC) of the frame, float or array.
+    utcoffset: local time minus UTC, in hours.
+    """
+    # shift to local time, and by half a day so that the noon-to-noon
+    # night becomes a midnight-to-midnight day:
+    localday = np.floor(np.asarray(mjd) + utcoffset/24. - 0.5).astype(int)
+    nights = [(mjdorigin + datetime.timedelta(days=int(d))).isoformat()
+                                             for d in np.atleast_1d(localday)]
+    if np.ndim(mjd) == 0:
+        return nights[0]
+    return nights
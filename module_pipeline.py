@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The stages of the reduction as tasks of a TaskGraph.
+
+Each plan function adds the tasks of one stage to the graph, with the tasks
+of the previous stages they depend on, and returns what the parent process
+needs to write to the database once they are done. 2_make_main_calibs.py
+only plans the calibrations, run_pipeline.py plans everything, frame by
+frame: a frame is reduced as soon as its calibrations exist and aligned as
+soon as it is reduced, whatever the other frames are doing.
+
+With a ProductCache, the products that are up to date get no task at all
+(the tasks depending on them see them as done).
+"""
+
+import hashlib
+from pathlib import Path
+import numpy as np
+
+from module_calibs import makeMain, reduceDark, reduceFlat
+from module_frame_tasks import makeCalibrationTerms, reduceFrame, \
+                               reduceFrameCCDProc
+from module_alignment import alignFrame, alignmentProduct, alignmentExists
+from module_reduction import darkScale
+from module_stack import stackFrames, stackPath
+
+
+def meanMJD(members):
+    # a main calibration is dated by the mean mjd of its frames, this is
+    # what the closest-in-time matching compares to.
+    return float(np.mean([e['mjd'] for e in members]))
+
+
+def reducedPath(workdir, entry):
+    filename = Path(entry['path']).name
+    return str(Path(workdir) / filename.replace('.fits', '_red.fits'))
+
+
+def upToDate(cache, product, stage, inputs, exists=None, **params):
+    # (no cache: nothing is)
+    return cache is not None and cache.check(product, stage, inputs, exists,
+                                             **params)
+
+
+def planCalibrations(db, tasks, matcher, calibdir, workdir, bias, dark, flat,
+                     combiner='tiled', taskmemory=2e9, flatstarremoval='fit',
+                     moffatfitter='batched', cache=None, variance=False,
+                     compression=None):
+    """
+    the main biases, darks and flats (and the reductions of the single
+    darks and flats they need), one per night.
+    bias, dark, flat: the imagetyp of each kind of calibration.
+    variance: whether the main calibrations keep their variance.
+    compression: of the files written (see module_fitsio).
+    The main calibrations are added to matcher as planned.
+    Returns (recno -> reduced path of the darks and flats,
+             table -> main calibrations to insert).
+    """
+    calibdir = Path(calibdir)
+    # the reduced darks and flats, recno -> reduced path
+    reduced = {}
+
+    # the frames come grouped by night (assigned at ingestion, noon to noon)
+    # and by whatever must match, each kind in one query.
+
+    ################################## biases #################################
+    mainbiases = []
+    biasgroups = db.selectGroups(['binning', 'night'], ['imagetyp'], [bias],
+                                 sortFields=['mjd'])
+    for (binning, night), members in biasgroups.items():
+        relevantfiles = [e['path'] for e in members]
+        path = str(calibdir / f"mainbias_night{night}_binning{binning}.fits")
+        if not upToDate(cache, path, 'mainbias', relevantfiles,
+                        combiner=combiner, variance=variance,
+                        compression=compression):
+            tasks.add(('mainbias', path), makeMain,
+                      (relevantfiles, path, combiner, taskmemory, variance,
+                       compression))
+        mainbiases.append({'date':night, 'mjd':meanMJD(members),
+                           'binning':binning, 'path':path})
+    matcher.addPlanned('mainbias', mainbiases)
+
+    ################################## darks ##################################
+    maindarks = []
+    darkgroups = db.selectGroups(['binning', 'exptime', 'night'],
+                                 ['imagetyp'], [dark], sortFields=['mjd'])
+    for (binning, exptime, night), members in darkgroups.items():
+        # each dark: subtract the closest main bias.
+        for entry in members:
+            mainbias = matcher.closest('mainbias', entry['mjd'],
+                                       binning=binning)
+            writepath = reducedPath(workdir, entry)
+            if not upToDate(cache, writepath, 'reduceddark',
+                            [entry['path'], mainbias['path']],
+                            compression=compression):
+                tasks.add(('reduced', entry['recno']), reduceDark,
+                          (entry['path'], mainbias['path'], writepath,
+                           compression),
+                          deps=[('mainbias', mainbias['path'])])
+            reduced[entry['recno']] = writepath
+
+        # all the darks of this night with this exptime and binning.
+        relevantfiles = [reduced[e['recno']] for e in members]
+        path = str(calibdir / f"maindark_night{night}_binning{binning}_exptime{exptime}.fits")
+        if not upToDate(cache, path, 'maindarks', relevantfiles,
+                        combiner=combiner, variance=variance,
+                        compression=compression):
+            tasks.add(('maindarks', path), makeMain,
+                      (relevantfiles, path, combiner, taskmemory, variance,
+                       compression),
+                      deps=[('reduced', e['recno']) for e in members])
+        maindarks.append({'date':night, 'mjd':meanMJD(members),
+                          'binning':binning, 'path':path, 'exptime':exptime})
+    matcher.addPlanned('maindarks', maindarks)
+
+    ################################## flats ##################################
+    mainflats = []
+    flatgroups = db.selectGroups(['binning', 'filter', 'night'],
+                                 ['imagetyp'], [flat], sortFields=['mjd'])
+    for (binning, filter, night), members in flatgroups.items():
+        # each flat: subtract the closest main bias and dark, mask or remove
+        # the stars.
+        for entry in members:
+            mainbias = matcher.closest('mainbias', entry['mjd'],
+                                       binning=binning)
+            maindark = matcher.closest('maindarks', entry['mjd'],
+                                       binning=binning)
+            writepath = reducedPath(workdir, entry)
+            if not upToDate(cache, writepath, 'reducedflat',
+                            [entry['path'], mainbias['path'],
+                             maindark['path']],
+                            starremoval=flatstarremoval,
+                            moffatfitter=moffatfitter,
+                            compression=compression):
+                tasks.add(('reduced', entry['recno']), reduceFlat,
+                          (entry['path'], entry['exptime'],
+                           mainbias['path'], maindark['path'],
+                           maindark['exptime'], writepath, flatstarremoval,
+                           moffatfitter, compression),
+                          deps=[('mainbias', mainbias['path']),
+                                ('maindarks', maindark['path'])])
+            reduced[entry['recno']] = writepath
+
+        # now we combine the flats
+        relevantfiles = [reduced[e['recno']] for e in members]
+        safefilter = filter.replace(' ', '').replace('/', '')
+        path = str(calibdir / f"mainflat_night{night}_binning{binning}_filter{safefilter}.fits")
+        if not upToDate(cache, path, 'mainflats', relevantfiles,
+                        combiner=combiner, variance=variance,
+                        compression=compression):
+            tasks.add(('mainflats', path), makeMain,
+                      (relevantfiles, path, combiner, taskmemory, variance,
+                       compression),
+                      deps=[('reduced', e['recno']) for e in members])
+        mainflats.append({'date':night, 'mjd':meanMJD(members),
+                          'binning':binning, 'path':path, 'filter':filter})
+    matcher.addPlanned('mainflats', mainflats)
+
+    return reduced, {'mainbias':mainbiases, 'maindarks':maindarks,
+                     'mainflats':mainflats}
+
+
+def recordCalibrations(db, reduced, products):
+    """
+    the database, in one go per table, once the calibrations are made.
+    """
+    db.updateBatch(['recno'], [[recno] for recno in reduced],
+                   [{'reducedpath':path} for path in reduced.values()])
+    for table, entries in products.items():
+        known = db.select(['recno'], ['*'], filter=['path'], tablename=table)
+        db.insertBatch([p for p in entries if not p['path'] in known],
+                       tablename=table)
+
+
+def planReduction(tasks, images, matcher, workdir, engine='fast',
+                  scaledark=False, variance=False, cache=None,
+                  compression=None):
+    """
+    each science frame: reduced as soon as its calibrations (and, with the
+    fast engine, the combined calibration terms) are there, written with
+    compression (see module_fitsio).
+    Returns recno -> reduced path (of all the frames, reduced in this run
+    or up to date).
+    """
+    workdir = Path(workdir)
+    reduced = {}
+    for image in images:
+        mainbias = matcher.closest('mainbias', image['mjd'],
+                                   binning=image['binning'])
+        maindark = matcher.closest('maindarks', image['mjd'],
+                                   binning=image['binning'])
+        mainflat = matcher.closest('mainflats', image['mjd'],
+                                   binning=image['binning'],
+                                   filter=image['filter'])
+        calibdeps = [('mainbias', mainbias['path']),
+                     ('maindarks', maindark['path']),
+                     ('mainflats', mainflat['path'])]
+        writepath = reducedPath(workdir, image)
+        reduced[image['recno']] = writepath
+        if upToDate(cache, writepath, 'reduce',
+                    [image['path'], mainbias['path'], maindark['path'],
+                     mainflat['path']],
+                    engine=engine, scaledark=scaledark, variance=variance,
+                    compression=compression):
+            continue
+        if engine == 'ccdproc':
+            tasks.add(('reduce', image['recno']), reduceFrameCCDProc,
+                      (image['path'], writepath, mainbias['path'],
+                       maindark['path'], mainflat['path'],
+                       maindark['exptime'], image['exptime'], scaledark,
+                       compression),
+                      deps=calibdeps)
+        else:
+            # the terms are shared by all the frames with the same
+            # calibrations, made once by their own task:
+            darkscale = darkScale(maindark['exptime'], image['exptime'],
+                                  scaledark)
+            key = (mainbias['path'], maindark['path'], mainflat['path'],
+                   darkscale)
+            if not ('terms', key) in tasks.tasks:
+                # named after the calibrations (the same from one run to
+                # the next), run_pipeline.py deletes them after the graph:
+                name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+                prefix = workdir / f"terms_{name}"
+                tasks.add(('terms', key), makeCalibrationTerms,
+                          (mainbias['path'], maindark['path'],
+                           mainflat['path'], darkscale, str(prefix),
+                           variance),
+                          deps=calibdeps)
+            tasks.add(('reduce', image['recno']), reduceFrame,
+                      lambda results, key=key, image=image,
+                             writepath=writepath:
+                          (image['path'], writepath, results[('terms', key)],
+                           compression),
+                      deps=[('terms', key)])
+    return reduced
+
+
+def planAlignment(tasks, images, refimg, reduced, crop=0, engine='auto',
+                  workdir=None, cache=None, compression=None):
+    """
+    each reduced frame: aligned on refimg as soon as both are reduced.
+    (with workdir, the aligned frames are written there as well, with
+    compression)
+    Returns recno -> aligned path (None without workdir).
+    """
+    refpath = reduced.get(refimg['recno'], refimg['reducedpath'])
+    aligned = {}
+    for image in images:
+        path = reduced.get(image['recno'], image['reducedpath'])
+        alignedpath = None
+        if workdir is not None:
+            alignedpath = reducedPath(workdir, image).replace('.fits',
+                                                             '_aligned.fits')
+        aligned[image['recno']] = alignedpath
+        if upToDate(cache, alignmentProduct(path), 'align', [path, refpath],
+                    alignmentExists(image, alignedpath), crop=crop,
+                    engine=engine, compression=compression):
+            continue
+        # a frame reduced in this run has new sources:
+        sources = image['sources']
+        if ('reduce', image['recno']) in tasks.tasks:
+            sources = None
+        tasks.add(('align', image['recno']), alignFrame,
+                  (path, sources, refpath, None, refimg['recno'], crop,
+                   engine, alignedpath, compression),
+                  deps=[('reduce', image['recno']),
+                        ('reduce', refimg['recno'])])
+    return aligned
+
+
+def planStacks(tasks, images, reduced, outdir, target, crop=0, mode='exact',
+               combiner='tiled', memorybudget=2e9, cache=None):
+    """
+    one stack per filter, when all its frames are aligned. The transforms
+    are the results of the alignment tasks.
+    """
+    filters = sorted(set(image['filter'] for image in images))
+    for filter in filters:
+        relevant = [image for image in images if image['filter'] == filter]
+        paths = [reduced.get(image['recno'], image['reducedpath'])
+                                                       for image in relevant]
+        # (the frames aligned in this run, or before if up to date)
+        aligns = [(('align', image['recno']), image['alignment'])
+                                                       for image in relevant]
+        path = str(stackPath(outdir, target, filter))
+        if upToDate(cache, path, 'stack',
+                    sorted(alignmentProduct(p) for p in paths),
+                    crop=crop, mode=mode, combiner=combiner):
+            continue
+        tasks.add(('stack', filter), stackFrames,
+                  lambda results, path=path, paths=paths, aligns=aligns:
+                      (path, paths, [results[a][0] if a in results else old
+                                                   for a, old in aligns],
+                       crop, mode, combiner, memorybudget),
+                  deps=[a for a, _ in aligns])
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bias, dark and flat correction of a frame.
+
+Two ways of doing the same thing:
+    - reduceCCDProc: the ccdproc chain (subtract_bias, subtract_dark,
+      flat_correct). Every step makes a new float64 CCDData. This is the
+      reference.
+    - reduceFast: the three calibrations are first folded into two
+      float32 arrays (calibrationTerms), which are the same for every frame
+      sharing those calibrations:
+          offset  = bias + darkscale * dark
+          invflat = mean(flat) / flat
+      and each frame then costs one subtraction and one multiplication,
+      done in place in a single float32 array:
+          (raw - offset) * invflat
+      reduceRows does the same reading the raw frame band by band.
+"""
+
+import numpy as np
+from ccdproc import CCDData, subtract_bias, subtract_dark, flat_correct
+from astropy.units import s
+
+
+def darkScale(darkexptime, exptime, scaledark):
+    """
+    ccdproc's subtract_dark only scales the dark to the exposure time of the
+    frame when asked to (scale=True), we do the same.
+    """
+    if scaledark:
+        return exptime / darkexptime
+    return 1.
+
+
+def calibrationTerms(bias, dark, flat, darkscale=1.,
+                     biasvar=None, darkvar=None, flatvar=None):
+    """
+    returns offset, invflat (float32), and if the variances of the
+    calibrations are given, the variance of offset and the relative variance
+    of the normalised flat as well.
+    """
+    offset = np.array(dark, dtype=np.float32)
+    offset *= darkscale
+    offset += bias
+    # flat_correct normalises the flat by its mean:
+    flatmean = np.mean(flat, dtype=np.float64)
+    invflat = np.array(flat, dtype=np.float32)
+    np.divide(flatmean, invflat, out=invflat)
+    if biasvar is None and darkvar is None and flatvar is None:
+        return offset, invflat
+
+    offsetvar = np.zeros_like(offset)
+    if biasvar is not None:
+        offsetvar += biasvar
+    if darkvar is not None:
+        offsetvar += darkscale**2 * np.asarray(darkvar, dtype=np.float32)
+    flatrelvar = np.zeros_like(invflat)
+    if flatvar is not None:
+        # (sigma_flat / flat)^2, the same for the normalised flat:
+        flatrelvar += flatvar
+        flatrelvar *= invflat**2 / flatmean**2
+    return offset, invflat, offsetvar, flatrelvar
+
+
+def reduceFast(raw, offset, invflat, offsetvar=None, flatrelvar=None,
+               rawvar=None, out=None):
+    """
+    (raw - offset) * invflat, in one float32 array (out if given).
+
+    Uncertainties are only propagated if offsetvar is given (then also
+    flatrelvar, and optionally the variance of the raw frame). In that case
+    returns (data, variance).
+    """
+    out = np.subtract(raw, offset, out=out, dtype=np.float32)
+    if offsetvar is None:
+        out *= invflat
+        return out
+
+    variance = np.array(offsetvar, dtype=np.float32)
+    if rawvar is not None:
+        variance += rawvar
+    variance *= invflat**2
+    out *= invflat
+    # error of a ratio: the relative error of the flat adds up as well.
+    variance += out**2 * flatrelvar
+    return out, variance
+
+
+def reduceRows(frame, offset, invflat, offsetvar=None, flatrelvar=None,
+               rowsper=256):
+    """
+    reduceFast on a frame read by bands of rows (a FitsFrame): only one
+    band of the raw frame is in memory at once, in its own dtype (an
+    integer frame is not converted to floats as a whole), and goes straight
+    into the float32 result. Returns the same as reduceFast.
+    """
+    ny = frame.shape[0]
+    out = np.empty(frame.shape, dtype=np.float32)
+    variance = None
+    if offsetvar is not None:
+        variance = np.empty(frame.shape, dtype=np.float32)
+    for r0 in range(0, ny, rowsper):
+        r1 = min(r0 + rowsper, ny)
+        raw, _ = frame.rows(r0, r1)
+        if variance is None:
+            reduceFast(raw, offset[r0:r1], invflat[r0:r1], out=out[r0:r1])
+        else:
+            _, variance[r0:r1] = reduceFast(raw, offset[r0:r1],
+                                            invflat[r0:r1],
+                                            offsetvar[r0:r1],
+                                            flatrelvar[r0:r1],
+                                            out=out[r0:r1])
+    if variance is None:
+        return out
+    return out, variance
+
+
+def reduceCCDProc(raw, bias, dark, flat, darkexptime, exptime,
+                  scaledark=False):
+    """
+    the reference ccdproc chain, on arrays. Returns a float32 array.
+    """
+    imgccd = CCDData(np.asarray(raw), unit='adu')
+    biasccd = CCDData(np.asarray(bias), unit='adu')
+    darkccd = CCDData(np.asarray(dark), unit='adu')
+    flatccd = CCDData(np.asarray(flat), unit='adu')
+    redimg1 = subtract_bias(imgccd, biasccd)
+    redimg2 = subtract_dark(redimg1, darkccd,
+                            dark_exposure=darkexptime*s,
+                            data_exposure=exptime*s,
+                            scale=scaledark)
+    redimg = flat_correct(redimg2, flatccd)
+    return redimg.data.astype(np.float32)
+
+
+def checkAgainstCCDProc(raw, bias, dark, flat, darkexptime, exptime,
+                        scaledark=False, tolerance=1e-5):
+    """
+    reduces the frame both ways and compares. Returns the largest
+    difference relative to the dynamic range of the reduced frame, raises
+    an AssertionError if it is above tolerance.
+    """
+    reference = reduceCCDProc(raw, bias, dark, flat, darkexptime, exptime,
+                              scaledark=scaledark)
+    darkscale = darkScale(darkexptime, exptime, scaledark)
+    offset, invflat = calibrationTerms(bias, dark, flat, darkscale)
+    fast = reduceFast(raw, offset, invflat)
+
+    scale = np.max(np.abs(reference))
+    difference = np.max(np.abs(fast - reference)) / scale
+    if difference > tolerance:
+        raise AssertionError(f"fast reduction differs from ccdproc by "
+                             f"{difference:.2e} (relative), more than "
+                             f"{tolerance:.0e}")
+    return difference
+
@@ -7,6 +7,7 @@ Created on Fri Apr 29 18:05:13 2022
 """
 
 
+import  time
 import  warnings
 import  numpy                    as     np
 from    astropy.utils.exceptions import AstropyUserWarning
@@ -14,6 +15,8 @@ from    astropy.io               import fits
 from    astropy.stats            import sigma_clipped_stats
 from    astropy.modeling         import models, fitting 
 
+from    scipy.ndimage            import binary_dilation, zoom, label
+from    scipy.spatial            import KDTree
 from    photutils.detection      import DAOStarFinder
 
 
@@ -62,37 +65,335 @@ def fitMoffatProfileAndReplace(fullimage, x0, y0, N=10, debug=0):
     leny, lenx    = stamp.shape
     x, y          = np.meshgrid(np.arange(lenx), np.arange(leny))
     
-    # on fit:
-    warnings.filterwarnings("error")
+    # on fit (un fit qui ne converge pas lève un warning, on le veut en erreur):
     try:
-        moffat        = fit_p(moffat, x, y, stamp)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", AstropyUserWarning)
+            moffat        = fit_p(moffat, x, y, stamp)
         model         = moffat(x,y)
         # on soustrait le modèle:
         residuals     = stamp - model
-    except AstropyUserWarning:
+        converged     = True
+    except (AstropyUserWarning, fitting.NonFiniteValueError):
         # ok, la psf de cette étoile est bizarre. Ou c'est une étoile double ...
         # mettons 0. Un peu plus moche, mais au moins pas un truc divergent
         residuals     = np.zeros_like(stamp) 
+        converged     = False
     
     # on remet le résultat dans l'image:
     addBackStampAndMedian(fullimage, residuals, median, x0, y0, N=N)
+    return converged
     
     
-def removeStarsFromArray(array):
+def extractStamps(array, positions, N=10):
+    """
+    all the stamps at once: (number of stars, 2N, 2N), the same region
+    as extractStampAndMedian. Where a stamp goes beyond the edge of the
+    image it is padded with NaNs, so that all stamps share the same grid
+    (the star being close to (N, N)).
+    """
+    shapey, shapex = array.shape
+    corners = np.floor(positions).astype(int) - N
+    offsets = np.arange(2*N)
+    xs = corners[:, 0, None] + offsets[None, :]
+    ys = corners[:, 1, None] + offsets[None, :]
+    inside = ((xs >= 0) & (xs < shapex))[:, None, :] & \
+             ((ys >= 0) & (ys < shapey))[:, :, None]
+    stamps = array[np.clip(ys, 0, shapey-1)[:, :, None],
+                   np.clip(xs, 0, shapex-1)[:, None, :]].astype(np.float64)
+    stamps[~inside] = np.nan
+    return stamps, corners
+
+
+def moffatAndJacobian(params, x, y):
+    """
+    Moffat2D (amplitude, x_0, y_0, gamma, alpha) of every star on the
+    stamp grid x, y, and its derivatives with respect to the 5 parameters.
+    params: (number of stars, 5). Returns model (n, ny, nx), 
+    jacobian (n, 5, ny, nx).
+    """
+    amplitude, x0, y0, gamma, alpha = [p[:, None, None] for p in params.T]
+    dx, dy = x[None] - x0, y[None] - y0
+    u = (dx**2 + dy**2) / gamma**2
+    base = 1 + u
+    model = amplitude * base**(-alpha)
+    common = 2 * amplitude * alpha * base**(-alpha-1) / gamma**2
+    jacobian = np.stack([base**(-alpha),
+                         common * dx,
+                         common * dy,
+                         common * u * gamma,
+                         -model * np.log(base)], axis=1)
+    return model, jacobian
+
+
+def fitMoffatBatch(stamps, params, maxiter=100, ftol=1.49e-8, xtol=1e-7):
+    """
+    Levenberg-Marquardt on all the stamps together, each with its own 
+    damping, stopping like scipy's leastsq (what LevMarLSQFitter uses) on
+    the relative decrease of the cost or the relative size of the step. 
+    NaN pixels (outside the image) do not count.
+    Returns the parameters and whether each fit converged.
+    """
+    n, leny, lenx = stamps.shape
+    x, y = np.meshgrid(np.arange(lenx), np.arange(leny))
+    valid = np.isfinite(stamps)
+    data = np.where(valid, stamps, 0.)
+    params = np.array(params, dtype=np.float64)
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    active = np.ones(n, dtype=bool)
+
+    def evaluate(p, which):
+        with np.errstate(all='ignore'):
+            model, jac = moffatAndJacobian(p, x, y)
+            residuals = np.where(valid[which], model - data[which], 0.)
+            cost = np.sum(residuals**2, axis=(1, 2))
+        return residuals, jac, cost
+
+    residuals, jac, cost = evaluate(params, slice(None))
+    for iteration in range(maxiter):
+        if not active.any():
+            break
+        a = np.flatnonzero(active)
+        with np.errstate(all='ignore'):
+            jaca = jac[a] * valid[a][:, None]
+            jtj = np.einsum('npyx,nqyx->npq', jaca, jaca)
+            grad = np.einsum('npyx,nyx->np', jaca, residuals[a])
+            diag = np.einsum('npp->np', jtj)
+            lhs = jtj + damping[a, None, None] * diag[:, :, None] \
+                                               * np.eye(5)[None]
+        if not np.all(np.isfinite(lhs)):
+            # a diverging fit, nothing to solve: those are failures.
+            bad = ~np.all(np.isfinite(lhs), axis=(1, 2))
+            active[a[bad]] = False
+            a, lhs, grad = a[~bad], lhs[~bad], grad[~bad]
+            if len(a) == 0:
+                break
+        step = -np.einsum('npq,nq->np', np.linalg.pinv(lhs), grad)
+        newparams = params[a] + step
+        newresiduals, newjac, newcost = evaluate(newparams, a)
+        better = np.isfinite(newcost) & (newcost <= cost[a])
+        # accepted steps: smaller damping (more Gauss-Newton), 
+        # rejected ones: larger damping (more gradient descent).
+        acc = a[better]
+        with np.errstate(all='ignore'):
+            relcost = (cost[acc] - newcost[better]) / cost[acc]
+            relstep = np.linalg.norm(step[better], axis=1) / \
+                      np.linalg.norm(params[acc], axis=1)
+        params[acc] = newparams[better]
+        residuals[acc] = newresiduals[better]
+        jac[acc] = newjac[better]
+        cost[acc] = newcost[better]
+        damping[acc] /= 10
+        damping[a[~better]] *= 10
+        done = (relcost <= ftol) | (relstep <= xtol)
+        converged[acc[done]] = True
+        active[acc[done]] = False
+        # a rejected step that small: we are at the minimum already.
+        rej = a[~better]
+        with np.errstate(all='ignore'):
+            tiny = np.linalg.norm(step[~better], axis=1) <= \
+                   xtol * np.linalg.norm(params[rej], axis=1)
+        converged[rej[tiny]] = True
+        active[rej[tiny]] = False
+    converged &= np.all(np.isfinite(params), axis=1)
+    return params, converged
+
+
+def overlapRounds(corners, N=10):
+    """
+    fitMoffatProfileAndReplace goes star by star, so a star sees the stars
+    before it already subtracted when their stamps overlap. To get the same
+    thing in batches, a star goes in the round after the last earlier star
+    it overlaps with: stars of a round are independent of each other, and
+    see the stars of the previous rounds subtracted.
+    (the overlapping pairs come from a KD-tree, not from every pair)
+    """
+    rounds = np.zeros(len(corners), dtype=int)
+    if len(corners) < 2:
+        return rounds
+    # stamps overlap when their corners are less than 2N apart in x and y:
+    pairs = KDTree(corners).query_pairs(2*N - 1, p=np.inf, 
+                                        output_type='ndarray')
+    # earlier -> later, in the order of the stars:
+    pairs = np.sort(pairs, axis=1)
+    pairs = pairs[np.argsort(pairs[:, 1], kind='stable')]
+    starts = np.searchsorted(pairs[:, 1], np.arange(len(corners)))
+    ends = np.searchsorted(pairs[:, 1], np.arange(len(corners)), 
+                           side='right')
+    for i in range(1, len(corners)):
+        if ends[i] > starts[i]:
+            rounds[i] = rounds[pairs[starts[i]:ends[i], 0]].max() + 1
+    return rounds
+
+
+def removeStarsBatched(array, positions, N=10):
+    """
+    fitMoffatProfileAndReplace on every star, but the stamps are extracted,
+    fitted and put back together (in a few rounds when stars overlap, see
+    overlapRounds), starting from the width measured on each star instead
+    of gamma = alpha = 0.3. The detections that are only noise are left
+    alone. A batched fit is only kept if it converged and leaves less than
+    the stamp itself, the other stars are fitted again one by one with 
+    fitMoffatProfileAndReplace (and zeroed if that fails too, as before).
+    Returns the number of detections left alone (noise), of stars fitted 
+    one by one, and of failed fits.
+    """
+    corners = np.floor(positions).astype(int) - N
+    rounds = overlapRounds(corners, N=N)
+    counts = np.zeros(3, dtype=int)
+    for r in range(rounds.max() + 1):
+        inround = rounds == r
+        counts += _removeStarsBatch(array, positions[inround], N=N)
+    return tuple(counts)
+
+
+def _removeStarsBatch(array, positions, N=10):
+    # one round of removeStarsBatched: stamps that do not overlap.
+    stamps, corners = extractStamps(array, positions, N=N)
+    # (on the pixels inside the image only)
+    valid = np.isfinite(stamps)
+    mean, medians, std = sigma_clipped_stats(stamps, mask=~valid, 
+                                             axis=(1, 2))
+    stamps -= medians[:, None, None]
+
+    # most detections of DAOStarFinder at 2 sigma are noise: the peak
+    # around the detected position must be 5 sigma above the background of
+    # the stamp, the others are left alone. Saturated stars (a flat top:
+    # 5 pixels or more around the peak within 2% of it) are fitted one by
+    # one.
+    center = stamps[:, N-1:N+2, N-1:N+2]
+    peaks = np.max(np.where(np.isfinite(center), center, -np.inf), 
+                   axis=(1, 2))
+    noise = peaks < 5 * std
+    with np.errstate(invalid='ignore'):
+        top = np.abs(stamps[:, N-2:N+3, N-2:N+3] - peaks[:, None, None]) \
+              <= 0.02 * np.abs(peaks[:, None, None])
+    saturated = ~noise & (np.sum(top, axis=(1, 2)) >= 5)
+    nfailed = 0
+    for x0, y0 in positions[saturated]:
+        nfailed += not fitMoffatProfileAndReplace(array, x0, y0, N=N)
+    star = ~noise & ~saturated
+    stamps, positions, corners, medians = stamps[star], positions[star], \
+                                          corners[star], medians[star]
+    peaks = peaks[star]
+    # the starting point: the detected position, and the width at half 
+    # maximum (from the number of pixels above it) for alpha = 2.5:
+    with np.errstate(invalid='ignore'):
+        fwhm = 2 * np.sqrt(np.sum(stamps > peaks[:, None, None] / 2, 
+                                  axis=(1, 2)) / np.pi)
+    params = np.zeros((len(stamps), 5))
+    params[:, 0] = peaks
+    params[:, 1] = positions[:, 0] - np.floor(positions[:, 0]) + N
+    params[:, 2] = positions[:, 1] - np.floor(positions[:, 1]) + N
+    params[:, 4] = 2.5
+    params[:, 3] = np.maximum(fwhm, 1) / (2 * np.sqrt(2**(1/2.5) - 1))
+    params, converged = fitMoffatBatch(stamps, params)
+
+    leny, lenx = stamps.shape[1:]
+    x, y = np.meshgrid(np.arange(lenx), np.arange(leny))
+    with np.errstate(all='ignore'):
+        models, _ = moffatAndJacobian(params, x, y)
+    residuals = stamps - models
+    # a star: positive, centred in its stamp, and the fit must explain
+    # something of the stamp:
+    amplitude, x0, y0, gamma, alpha = params.T
+    with np.errstate(invalid='ignore'):
+        keep = converged & (amplitude > 0) & (alpha > 0) \
+               & (np.abs(x0 - N) <= N) & (np.abs(y0 - N) <= N) \
+               & (np.nansum(residuals**2, axis=(1, 2)) 
+                  <= np.nansum(stamps**2, axis=(1, 2)))
+
+    shapey, shapex = array.shape
+    for (xc, yc), residual, median in zip(corners[keep], residuals[keep], 
+                                          medians[keep]):
+        xlow, ylow = max(0, xc), max(0, yc)
+        xhigh, yhigh = min(shapex, xc+lenx), min(shapey, yc+leny)
+        array[ylow:yhigh, xlow:xhigh] = \
+            residual[ylow-yc:yhigh-yc, xlow-xc:xhigh-xc] + median
+    # the others one by one (they do not overlap, the order is irrelevant):
+    for x0, y0 in positions[~keep]:
+        nfailed += not fitMoffatProfileAndReplace(array, x0, y0, N=N)
+    return np.count_nonzero(noise), \
+           np.count_nonzero(saturated) + np.count_nonzero(~keep), nfailed
+
+
+def removeStarsFromArray(array, mode='batched'):
+    """
+    mode: 'batched' (the stars fitted together, removeStarsBatched) or 
+          'serial' (one LevMarLSQFitter per detection).
+    """
     mean, median, std  = sigma_clipped_stats(array)
     daofind            = DAOStarFinder(threshold=2*std, fwhm=3.5)
     try:
         sources            = daofind(array-median)
     except:
         return array
-    print(f"found {len(sources)} stars.")
+    if sources is None:
+        # no star at all.
+        return array
     
+    t0 = time.time()
     positions = np.transpose((sources['xcentroid'], sources['ycentroid']))
-    for x0, y0 in positions:
-        fitMoffatProfileAndReplace(array, x0, y0, N=10, debug=0)
+    if mode == 'serial':
+        details = ""
+        nfailed = 0
+        for x0, y0 in positions:
+            nfailed += not fitMoffatProfileAndReplace(array, x0, y0, N=10, 
+                                                      debug=0)
+    else:
+        # the brightest first: their wings are gone when the fainter stars
+        # around them are fitted (and the detections on those wings are 
+        # then just noise).
+        order = np.argsort(-np.asarray(sources['flux']), kind='stable')
+        nnoise, nserial, nfailed = removeStarsBatched(array, positions[order],
+                                                      N=10)
+        details = f" ({nnoise} noise, {nserial} fitted one by one)"
+    dt = max(time.time() - t0, 1e-6)
+    print(f"found {len(sources)} stars{details}, removed in {dt:.2f} s "
+          f"({len(sources)/dt:.0f} stars/s), {nfailed} fits failed.")
     return array 
 
 
+def smoothBackground(array, box=32):
+    """
+    the large scale structure of the flat (vignetting, gradients): median
+    of each box x box block, interpolated back to the full frame.
+    """
+    ny, nx = array.shape
+    by, bx = max(1, ny // box), max(1, nx // box)
+    blocks = array[:by*box, :bx*box].reshape(by, box, bx, box)
+    medians = np.nanmedian(blocks, axis=(1, 3))
+    return zoom(medians, (ny/by, nx/bx), order=1, grid_mode=True, 
+                mode='nearest')
+
+
+def starMaskFromArray(array, nsigma=3, dilation=5, npixels=5):
+    """
+    for dithered flats, no need to subtract the stars: we flag their pixels
+    (at least npixels connected pixels above nsigma of the background, 
+    grown by dilation pixels) and leave them out of the combination of the
+    flats.
+    Returns a boolean mask, True on the stars.
+    """
+    residual = array - smoothBackground(array)
+    mean, median, std = sigma_clipped_stats(residual)
+    mask = residual > median + nsigma * std
+    # single pixels above the threshold are noise (0.1% of the pixels at
+    # 3 sigma), a star is a group of them:
+    labels, nlabels = label(mask)
+    sizes = np.bincount(labels.ravel(), minlength=nlabels+1)
+    keep = sizes >= npixels
+    keep[0] = False
+    mask = keep[labels]
+    if dilation > 0:
+        y, x = np.ogrid[-dilation:dilation+1, -dilation:dilation+1]
+        disk = x**2 + y**2 <= dilation**2
+        mask = binary_dilation(mask, structure=disk)
+    print(f"masked {np.count_nonzero(mask)/mask.size:.2%} of the flat.")
+    return mask
+
+
 if __name__ == "__main__":
     from database import ImageBase
     from config import  dbname
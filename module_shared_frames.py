@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frames read once by the parent process and shared with the pool workers.
+
+The main calibrations are the same few files for hundreds of science frames:
+the parent loads each of them once (as float32) into a
+multiprocessing.shared_memory block, and the workers get numpy views of that
+memory instead of reading (and holding) their own copies.
+"""
+
+import numpy as np
+from multiprocessing import shared_memory
+from astropy.io import fits
+
+
+class SharedFrames():
+    def __init__(self):
+        # path -> (name of the shared memory block, shape)
+        self.frames = {}
+        # the blocks we created (parent) or attached to (workers), and
+        # the views we have:
+        self._blocks = []
+        self._attached = []
+        self._views = {}
+
+    def load(self, path):
+        """
+        to be called by the parent, before creating the pool.
+        """
+        path = str(path)
+        if path in self.frames:
+            return
+        self.add(path, fits.getdata(path))
+        
+    def add(self, key, data):
+        """
+        same as load, for an array we already have (e.g. computed from 
+        several calibrations), retrieved with get(key).
+        """
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(data.size*4, 1))
+        view = np.ndarray(data.shape, dtype=np.float32, buffer=block.buf)
+        view[:] = data
+        view.flags.writeable = False
+        self.frames[key] = (block.name, data.shape)
+        self._blocks.append(block)
+        self._views[key] = view
+
+    def get(self, path):
+        """
+        read only float32 view of the frame. No copy: forked workers
+        inherit our views, others attach to the blocks by name.
+        """
+        path = str(path)
+        if not path in self._views:
+            name, shape = self.frames[path]
+            block = shared_memory.SharedMemory(name=name)
+            view = np.ndarray(shape, dtype=np.float32, buffer=block.buf)
+            view.flags.writeable = False
+            # keep the block alive as long as its view:
+            self._views[path] = view
+            self._attached.append(block)
+        return self._views[path]
+
+    def __getstate__(self):
+        # when sent to a worker, only the names travel.
+        return {'frames':self.frames}
+
+    def __setstate__(self, state):
+        self.frames = state['frames']
+        self._blocks = []
+        self._attached = []
+        self._views = {}
+
+    def close(self):
+        """
+        to be called by the parent once the workers are done.
+        """
+        self._views = {}
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
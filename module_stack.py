@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stacking of the aligned frames, per filter.
+
+Two ways:
+    - exact: combineTiled on the frames warped as they are read
+      (WarpedFrame), clipping around the median of each pixel. Needs all
+      the frames to be there.
+    - streaming: StreamingStacker takes the frames one by one, as they
+      come out of the reduction and alignment, and adds each into running
+      sums (first pass). The median is not something we can accumulate, so
+      the clipping (low_thresh, high_thresh standard deviations) is around
+      the mean of the first pass, and done in a second pass over the
+      frames (finish). Nothing but the accumulators is kept in memory, and
+      no aligned frame is ever written.
+    - incremental: the accumulators of a streaming stack (StackState) are
+      saved, and the frames of the next night are added to them, in
+      two passes over these frames only. The frames that were already there
+      were clipped against the statistics of their time: an approximation,
+      a rebuild (exact, from all the frames) is always possible.
+"""
+
+from pathlib import Path
+import numpy as np
+from astropy.io import fits
+
+from database import stacksfields, stacksindexes
+from module_combine import combine
+from module_alignment import WarpedFrame, alignmentReference
+from module_trace import span
+
+
+def warpFrame(path, alignment, crop=0):
+    # the whole frame, on the grid of the (cropped) reference.
+    with span('warp', path=path):
+        frame = WarpedFrame(path, alignment, crop=crop)
+        try:
+            data, _ = frame.rows(0, frame.shape[0])
+        finally:
+            frame.close()
+    return data
+
+
+class StackState():
+    """
+    the running statistics of a stack, per pixel, over frames scaled by
+    the inverse of their mean (like combine(..., scaling='mean')):
+        n, mean, m2: number of frames, mean and sum of squared deviations
+                     (Welford) of all the frames, for the clipping limits,
+        total, count: sum and number of the pixels kept by the clipping.
+    add is the first pass (statistics), finish the second (clipping of the
+    frames added since the last finish).
+    """
+    def __init__(self, crop=0, low_thresh=2, high_thresh=4):
+        self.crop = crop
+        self.low_thresh = low_thresh
+        self.high_thresh = high_thresh
+        self.n = 0
+        self.mean = self.m2 = self.total = self.count = None
+        # (path, alignment, scaling) of the frames waiting for finish:
+        self.pending = []
+
+    def add(self, path, alignment):
+        data = warpFrame(path, alignment, crop=self.crop).astype(np.float64)
+        scaling = 1 / np.mean(data)
+        data *= scaling
+        if self.n == 0:
+            self.mean = np.zeros_like(data)
+            self.m2 = np.zeros_like(data)
+            self.total = np.zeros_like(data)
+            self.count = np.zeros(data.shape, dtype=np.int32)
+        self.n += 1
+        delta = data - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (data - self.mean)
+        self.pending.append((path, alignment, scaling))
+
+    def finish(self):
+        """
+        the pending frames again, keeping only the pixels within the
+        clipping limits. Returns the stack.
+        """
+        std = np.sqrt(self.m2 / self.n)
+        low = self.mean - self.low_thresh * std
+        high = self.mean + self.high_thresh * std
+        for path, alignment, scaling in self.pending:
+            data = warpFrame(path, alignment, crop=self.crop)
+            data = data.astype(np.float64) * scaling
+            keep = (data >= low) & (data <= high)
+            self.total[keep] += data[keep]
+            self.count += keep
+        self.pending = []
+        return self.stack
+
+    @property
+    def stack(self):
+        # the clipped mean (NaN where everything was rejected).
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.total / self.count
+
+    def save(self, path):
+        if len(self.pending) > 0:
+            raise RuntimeError("finish the stack before saving it.")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, n=self.n, mean=self.mean, m2=self.m2, 
+                 total=self.total, count=self.count, crop=self.crop,
+                 thresholds=[self.low_thresh, self.high_thresh])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            low_thresh, high_thresh = saved['thresholds']
+            state = cls(crop=int(saved['crop']), low_thresh=low_thresh,
+                        high_thresh=high_thresh)
+            state.n = int(saved['n'])
+            for name in ['mean', 'm2', 'total', 'count']:
+                setattr(state, name, saved[name])
+        return state
+
+
+class StreamingStacker():
+    """
+    one StackState per filter.
+    """
+    def __init__(self, crop=0, low_thresh=2, high_thresh=4):
+        self.crop = crop
+        self.low_thresh = low_thresh
+        self.high_thresh = high_thresh
+        self.accumulators = {}
+
+    def add(self, filter, path, alignment):
+        if not filter in self.accumulators:
+            self.accumulators[filter] = StackState(self.crop, self.low_thresh,
+                                                   self.high_thresh)
+        self.accumulators[filter].add(path, alignment)
+
+    def finish(self, filter):
+        return self.accumulators[filter].finish()
+
+
+def stackPath(outdir, target, filter, suffix='.fits'):
+    safefilter = filter.replace(' ', '').replace('/', '')
+    return Path(outdir) / f"{target}_filter{safefilter}{suffix}"
+
+
+def writeStack(path, data):
+    """
+    the stack, normalised between 0 and 1.
+    """
+    data = np.array(data, dtype=np.float32)
+    data -= np.nanmin(data)
+    data /= np.nanmax(data)
+    with span('write', path=path):
+        fits.writeto(path, data, overwrite=True)
+
+
+def exactStack(paths, alignments, crop=0, combiner='tiled', memorybudget=2e9):
+    # the frames are aligned on the fly as they are read, tile by tile:
+    frames = [WarpedFrame(path, alignment, crop=crop)
+                                for path, alignment in zip(paths, alignments)]
+    # each frame is scaled by the inverse of its mean before combining:
+    av = combine(frames, engine=combiner, scaling='mean',
+                 memorybudget=memorybudget)
+    for frame in frames:
+        frame.close()
+    return av.data
+
+
+def stackFrames(path, paths, alignments, crop=0, mode='exact',
+                combiner='tiled', memorybudget=2e9):
+    """
+    the stack of the frames at paths (with their alignments), 'exact' or
+    'streaming', written to path. A task of the pipeline.
+    """
+    if mode == 'streaming':
+        state = StackState(crop=crop)
+        for framepath, alignment in zip(paths, alignments):
+            state.add(framepath, alignment)
+        data = state.finish()
+    else:
+        data = exactStack(paths, alignments, crop, combiner, memorybudget)
+    writeStack(path, data)
+    return str(path)
+
+
+def markForRebuild(db, images):
+    """
+    the frames of images (database entries) are about to be reduced or
+    aligned again: their old version cannot be taken out of the sums of the
+    incremental stacks they are in, those are rebuilt at the next run.
+    """
+    stale = sorted(set((e['object'], e['filter']) for e in images
+                                                  if e['stacked']))
+    if len(stale) == 0:
+        return
+    db.create(stacksfields, tablename='stacks', indexes=stacksindexes)
+    db.updateBatch(['target', 'filter'], [list(k) for k in stale],
+                   [{'stale':1}] * len(stale), tablename='stacks')
+
+
+def incrementalStack(db, target, filter, relevant, outdir, crop=0,
+                     rebuild=False, combiner='tiled', memorybudget=2e9):
+    """
+    adds the frames of relevant (database entries) not stacked yet to the
+    saved state of this target and filter, returns the stack. Everything is
+    done again if there is no state, if the frames were aligned on another
+    reference, if a stacked frame was reduced or aligned again since
+    (markForRebuild), if the state has another crop, or if we are asked to
+    (rebuild, then the stack returned is the exact one).
+    """
+    statepath = stackPath(Path(outdir) / 'stackstates', target, filter,
+                          suffix='_state.npz')
+    saved = db.select(['target', 'filter'], [target, filter],
+                      tablename='stacks', returnType='dict')
+    references = set(alignmentReference(e['alignment']) for e in relevant)
+    reference = references.pop() if len(references) == 1 else None
+    restart = rebuild or len(saved) == 0 or not statepath.exists() \
+              or reference is None or not saved[0]['reference'] == reference \
+              or bool(saved[0]['stale'])
+    if not restart:
+        state = StackState.load(statepath)
+        restart = not state.crop == crop
+    if restart:
+        state = StackState(crop=crop)
+        new = relevant
+    else:
+        new = [e for e in relevant if not e['stacked']]
+    print(f"{filter}: {len(new)} frames to add to the stack "
+          f"({'rebuild' if restart else f'{state.n} already in'}).")
+    for e in new:
+        state.add(e['reducedpath'], e['alignment'])
+    data = state.finish()
+    state.save(statepath)
+
+    if restart:
+        db.updateBatch(['object', 'filter'], [[target, filter]],
+                       [{'stacked':0}])
+    db.updateBatch(['recno'], [[e['recno']] for e in new],
+                   [{'stacked':1}] * len(new))
+    entry = {'target':target, 'filter':filter, 'path':str(statepath),
+             'nframes':state.n, 'reference':reference, 'stale':0}
+    if len(saved) == 0:
+        db.insert(entry, tablename='stacks')
+    else:
+        db.update(['recno'], [saved[0]['recno']], entry, tablename='stacks')
+    if rebuild:
+        return exactStack([e['reducedpath'] for e in relevant],
+                          [e['alignment'] for e in relevant], crop, combiner,
+                          memorybudget)
+    return data
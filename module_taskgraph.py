@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A (very) small dependency graph of tasks, run on a multiprocessing pool.
+
+Each task is a picklable function with its arguments, and the names of the
+tasks it depends on. A task is sent to the pool as soon as all its
+dependencies are done, so independent branches of the graph run in parallel
+and nothing waits for a whole "stage" to finish.
+
+The time each task spends in its worker is recorded, utilisation() sums it
+up by stage (the first element of the task names, e.g. 'reduce' for
+('reduce', 12)).
+"""
+
+import time
+import queue
+
+from module_trace import span
+
+
+def _timed(name, func, args):
+    # runs in the worker.
+    start = time.time()
+    stage = name[0] if isinstance(name, tuple) else name
+    with span(f"task {stage}", task=name):
+        result = func(*args)
+    return result, start, time.time()
+
+
+class TaskGraph():
+    def __init__(self):
+        # name -> (function, args, names of the dependencies)
+        self.tasks = {}
+
+    def add(self, name, func, args=(), deps=[]):
+        """
+        deps that are not (or not yet) tasks of this graph are considered
+        done: e.g. a calibration that already exists on disk.
+        args can also be a function, called with the results so far when the
+        task is submitted, returning the arguments: for tasks that need the
+        results of their dependencies.
+        """
+        if name in self.tasks:
+            raise RuntimeError(f"task {name} already in the graph!")
+        self.tasks[name] = (func, args, list(deps))
+
+    def run(self, pool, verbose=True, ondone=None):
+        """
+        runs everything on pool, returns {name: result of the task}.
+        Exceptions raised by a task are raised again here.
+        ondone(name, result) is called (in this process) as each task 
+        finishes, e.g. to write its result to the database.
+        """
+        deps = {name:set(d for d in task[2] if d in self.tasks)
+                                        for name, task in self.tasks.items()}
+        dependents = {name:[] for name in self.tasks}
+        for name, d in deps.items():
+            for dep in d:
+                dependents[dep].append(name)
+        self._checkForCycles(deps)
+
+        done = queue.Queue()
+        results = {}
+        running = 0
+        # name -> (start, end) in the worker:
+        self.timings = {}
+        self.start = time.time()
+
+        def submit(name):
+            func, args, _ = self.tasks[name]
+            if callable(args):
+                args = args(results)
+            pool.apply_async(_timed, (name, func, args),
+                             callback=lambda r: done.put((name, r, None)),
+                             error_callback=lambda e: done.put((name, None, e)))
+
+        for name, d in deps.items():
+            if len(d) == 0:
+                submit(name)
+                running += 1
+        while running > 0:
+            name, result, error = done.get()
+            running -= 1
+            if error is not None:
+                raise RuntimeError(f"task {name} failed") from error
+            result, start, end = result
+            results[name] = result
+            self.timings[name] = (start, end)
+            if ondone is not None:
+                ondone(name, result)
+            if verbose:
+                print(f"done: {name} ({len(results)}/{len(self.tasks)})")
+            for dependent in dependents[name]:
+                deps[dependent].discard(name)
+                if len(deps[dependent]) == 0:
+                    submit(dependent)
+                    running += 1
+        self.end = time.time()
+        return results
+
+    def utilisation(self, nworkers):
+        """
+        after run: {stage: (number of tasks, busy time, first start, last end,
+        fraction of the workers' time spent on this stage during the run)}
+        (times in seconds from the start of the run).
+        """
+        wall = max(self.end - self.start, 1e-9)
+        stages = {}
+        for name, (start, end) in self.timings.items():
+            stage = name[0] if isinstance(name, tuple) else name
+            n, busy, first, last = stages.get(stage, (0, 0., end, start))
+            stages[stage] = (n + 1, busy + end - start, min(first, start),
+                             max(last, end))
+        return {stage:(n, busy, first - self.start, last - self.start,
+                       busy / (wall * nworkers))
+                for stage, (n, busy, first, last) in stages.items()}
+
+    def _checkForCycles(self, deps):
+        # topological sort, whatever is left is in a cycle.
+        remaining = {name:set(d) for name, d in deps.items()}
+        ready = [name for name, d in remaining.items() if len(d) == 0]
+        while ready:
+            name = ready.pop()
+            del remaining[name]
+            for other, d in remaining.items():
+                if name in d:
+                    d.discard(name)
+                    if len(d) == 0:
+                        ready.append(other)
+        if len(remaining) > 0:
+            raise RuntimeError(f"cycle in the task graph: {list(remaining)}")
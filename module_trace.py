@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Where the time goes: spans (a name, start and end) recorded around the
+frames and the operations of the pipeline, with what the process read and
+wrote meanwhile, its peak memory and the number of sqlite queries.
+
+    startTracing(tracedir, '3_reduce_images')   # at the top of a script
+    ...
+    with readSpan(path):
+        raw = fits.getdata(path)
+    with span('reduce'):
+        ...
+
+Nothing is recorded unless startTracing was called with a directory (then
+span costs a couple of microseconds, else nothing). Every process, pool
+workers included (they inherit the tracer when they are forked), appends
+its spans to its own tracedir/<name>/<pid>.jsonl, line by line: nothing is
+lost when a worker is terminated. When the script exits, the files are
+merged into tracedir/<name>_trace.json, to open in chrome://tracing or
+https://ui.perfetto.dev, and a summary by span name is printed.
+
+The bytes are the rchar/wchar of /proc/self/io: everything read and written
+by the process (files, page cache hits included, but also pipes), so
+within threads they are those of the whole process. Reads through a memory
+map (astropy's default for fits data) are not in there: readSpan counts
+the size of the file it reads instead. The peak memory is the peak
+resident size of the process so far (resource.getrusage).
+"""
+
+import os
+import json
+import time
+import atexit
+import resource
+import threading
+from pathlib import Path
+
+
+# the tracer of this process, None when we are not tracing:
+_tracer = None
+# sqlite queries run by this process (ImageBase counts them):
+_queries = 0
+
+
+def countQueries(n=1):
+    global _queries
+    _queries += n
+
+
+def _io():
+    # (bytes read, bytes written) by this process so far.
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _peakRSS():
+    # in MB (ru_maxrss is in kB on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _Span():
+    def __init__(self, tracer, name, args, minread=0):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.minread = minread
+
+    def __enter__(self):
+        self.queries = _queries
+        self.io = _io()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        end = time.time()
+        read, written = _io()
+        self.tracer.write({'name':self.name, 'pid':os.getpid(),
+                           'tid':threading.get_ident(),
+                           'start':self.start, 'end':end,
+                           'read':max(read - self.io[0], self.minread),
+                           'written':written - self.io[1],
+                           'peakrss':_peakRSS(),
+                           'queries':_queries - self.queries,
+                           'args':self.args})
+
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_nospan = _NoSpan()
+
+
+class Tracer():
+    def __init__(self, tracedir, name):
+        self.tracedir = Path(tracedir)
+        self.name = name
+        self.spandir = self.tracedir / name
+        self.spandir.mkdir(parents=True, exist_ok=True)
+        # the spans of a previous run of the same script:
+        for old in self.spandir.glob('*.jsonl'):
+            old.unlink()
+        self.pid = os.getpid()
+        self.file = None
+        self.filepid = None
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            if not self.filepid == os.getpid():
+                # first span of this process (or a forked worker that
+                # inherited the file of its parent):
+                self.file = open(self.spandir / f"{os.getpid()}.jsonl", 'a')
+                self.filepid = os.getpid()
+            self.file.write(line)
+            self.file.flush()
+
+    def records(self):
+        records = []
+        for path in sorted(self.spandir.glob('*.jsonl')):
+            with open(path) as f:
+                records += [json.loads(line) for line in f if line.strip()]
+        return records
+
+    def finish(self, verbose=True):
+        """
+        merges the spans of all the processes into the chrome trace, and
+        prints the summary. (only in the process that started the tracing)
+        """
+        if not os.getpid() == self.pid:
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.filepid = None
+        records = self.records()
+        path = self.tracedir / f"{self.name}_trace.json"
+        writeChromeTrace(records, path)
+        if verbose:
+            print(summaryTable(records))
+            print(f"trace written to {path}")
+        return path
+
+
+def startTracing(tracedir, name):
+    """
+    starts recording the spans of this process (and of the processes it
+    forks from now on) in tracedir, if tracedir is not None. The trace is
+    merged and summarised when the process exits.
+    """
+    global _tracer
+    if tracedir is None:
+        return None
+    _tracer = Tracer(tracedir, name)
+    atexit.register(_tracer.finish)
+    # the whole run, as the span everything else is nested in:
+    root = _Span(_tracer, name, {})
+    root.__enter__()
+    atexit.register(lambda: root.__exit__()
+                              if os.getpid() == _tracer.pid else None)
+    return _tracer
+
+
+def span(name, **args):
+    """
+    context manager recording the time spent in its block (and the rest,
+    see above) under name. args (e.g. the frame) go to the trace.
+    """
+    if _tracer is None:
+        return _nospan
+    return _Span(_tracer, name, args)
+
+
+def readSpan(path, **args):
+    """
+    span('read', path=path), reading at least the size of the file.
+    """
+    if _tracer is None:
+        return _nospan
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    return _Span(_tracer, 'read', dict(args, path=path), minread=size)
+
+
+def writeChromeTrace(records, path):
+    # "complete" events, in microseconds, from the start of the run.
+    t0 = min((r['start'] for r in records), default=0)
+    events = [{'name':r['name'], 'ph':'X', 'pid':r['pid'], 'tid':r['tid'],
+               'ts':(r['start'] - t0) * 1e6,
+               'dur':(r['end'] - r['start']) * 1e6,
+               'args':dict(r['args'], read=r['read'], written=r['written'],
+                           peakrss=r['peakrss'], queries=r['queries'])}
+              for r in records]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, f)
+
+
+def summary(records):
+    """
+    by span name: {name: {count, total, mean, max (seconds), read, written
+    (MB), peakrss (MB), queries}}
+    """
+    result = {}
+    for r in records:
+        s = result.setdefault(r['name'], {'count':0, 'total':0., 'max':0.,
+                                          'read':0., 'written':0.,
+                                          'peakrss':0., 'queries':0})
+        duration = r['end'] - r['start']
+        s['count'] += 1
+        s['total'] += duration
+        s['max'] = max(s['max'], duration)
+        s['read'] += r['read'] / 1e6
+        s['written'] += r['written'] / 1e6
+        s['peakrss'] = max(s['peakrss'], r['peakrss'])
+        s['queries'] += r['queries']
+    for s in result.values():
+        s['mean'] = s['total'] / s['count']
+    return result
+
+
+def summaryTable(records):
+    lines = [f"{'span':<24} {'count':>6} {'total (s)':>10} {'mean (s)':>9} "
+             f"{'max (s)':>8} {'read MB':>8} {'wrote MB':>9} {'peak MB':>8} "
+             f"{'queries':>8}"]
+    stats = summary(records)
+    for name in sorted(stats, key=lambda n: -stats[n]['total']):
+        s = stats[name]
+        lines.append(f"{name[:24]:<24} {s['count']:>6} {s['total']:>10.2f} "
+                     f"{s['mean']:>9.3f} {s['max']:>8.2f} {s['read']:>8.1f} "
+                     f"{s['written']:>9.1f} {s['peakrss']:>8.0f} "
+                     f"{s['queries']:>8}")
+    return '\n'.join(lines)
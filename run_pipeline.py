@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The whole chain in one go: ingestion, main calibrations, reduction,
+alignment and stacking of the target.
+
+Rather than one pool per script, each waiting for the previous stage to be
+done with every frame, all the stages are tasks of one graph, run on one
+pool: a science frame is reduced as soon as its calibrations exist, aligned
+as soon as it (and the reference) is reduced, and the stack of a filter is
+made when its frames are aligned (with stackmode 'streaming', each frame 
+goes into the sums of its filter as soon as it is aligned, in this 
+process, while the pool goes on). The time the workers spent in each stage
+is printed at the end.
+
+(1_add_images.py to 5_stack.py still do the same, stage by stage.)
+"""
+
+import time
+import multiprocessing
+from pathlib import Path
+
+
+from database import ImageBase, BatchWriter, minimaldbfields, \
+                     minimaldbindexes, mainbiasfields, mainbiasindexes, \
+                     maindarksfields, maindarksindexes, mainflatsfields, \
+                     mainflatsindexes, stacksfields, stacksindexes
+from module_ingest import ingest
+from module_calibration_matching import CalibrationMatcher
+from module_taskgraph import TaskGraph
+from module_alignment import chooseReference, alignmentProduct
+from module_cache import ProductCache
+from module_pipeline import planCalibrations, recordCalibrations, \
+                            planReduction, planAlignment, planStacks
+from module_stack import incrementalStack, stackPath, writeStack, \
+                         markForRebuild, StreamingStacker
+from config import  datadir, dbname, calibdir, outdir, workdir, target, \
+                    flat, bias, dark, light, maxcores, dbwal, dbbatchsize, \
+                    ingestthreads, utcoffset, combiner, combinememory, \
+                    flatstarremoval, moffatfitter, reductionengine, \
+                    scaledark, reductionvariance, crop, alignengine, \
+                    writealigned, stackmode, stackrebuild, cacheproducts, \
+                    intermediatecompression, tracedir
+from module_trace import startTracing
+
+# (spans of this run, see module_trace.py, if tracedir is set)
+startTracing(tracedir, 'run_pipeline')
+
+t0 = time.time()
+workdir = Path(workdir)
+
+db = ImageBase(dbname, wal=dbwal)
+db.create(minimaldbfields, indexes=minimaldbindexes)
+db.setUnique('path')
+db.create(mainflatsfields, tablename='mainflats', indexes=mainflatsindexes)
+db.create(mainbiasfields, tablename='mainbias', indexes=mainbiasindexes)
+db.create(maindarksfields, tablename='maindarks', indexes=maindarksindexes)
+db.create(stacksfields, tablename='stacks', indexes=stacksindexes)
+
+################################## ingestion ##################################
+# (threads reading headers, before the pool exists)
+nscanned, nnew, nchanged, dt = ingest(db, datadir,
+                                      [calibdir, outdir, workdir],
+                                      threads=ingestthreads,
+                                      utcoffset=utcoffset)
+print(f"Scanned {nscanned} files, added {nnew} and updated "
+      f"{nchanged} images in {dt:.1f} s")
+
+################################### planning ##################################
+# the products made by previous runs from the same inputs, with the same
+# parameters, get no task:
+cache = ProductCache(db, enabled=cacheproducts)
+matcher = CalibrationMatcher(db)
+tasks = TaskGraph()
+taskmemory = combinememory / maxcores
+calibsreduced, products = planCalibrations(db, tasks, matcher, calibdir,
+                                           workdir, bias, dark, flat,
+                                           combiner, taskmemory,
+                                           flatstarremoval, moffatfitter,
+                                           cache, reductionvariance,
+                                           intermediatecompression)
+
+images = db.select(['object', 'imagetyp'], [target, light],
+                   sortFields=['mjd'], returnType='dict')
+refimg = chooseReference(images)
+
+reduced = planReduction(tasks, images, matcher, workdir, reductionengine,
+                        scaledark, reductionvariance, cache,
+                        intermediatecompression)
+aligned = planAlignment(tasks, images, refimg, reduced, crop, alignengine,
+                        workdir if writealigned else None, cache,
+                        intermediatecompression)
+if stackmode == 'exact':
+    # (the streaming stacks are fed by ondone below, the incremental ones
+    # need the database, they are done here after the run)
+    planStacks(tasks, images, reduced, outdir, target, crop, stackmode,
+               combiner, taskmemory, cache)
+
+# the incremental stacks with an old version of the frames done again are
+# rebuilt:
+markForRebuild(db, [image for image in images
+                      if ('reduce', image['recno']) in tasks.tasks
+                      or ('align', image['recno']) in tasks.tasks])
+
+################################### let's go ##################################
+print(f"{len(tasks.tasks)} tasks to run.")
+engines = {'fft':0, 'astroalign':0}
+# streaming stacks: the frames aligned before go in first, the others as
+# their alignment task is done.
+stacker = StreamingStacker(crop=crop)
+byrecno = {image['recno']:image for image in images}
+if stackmode == 'streaming':
+    for image in images:
+        if not ('align', image['recno']) in tasks.tasks \
+                and image['alignment'] is not None:
+            stacker.add(image['filter'], image['reducedpath'], 
+                        image['alignment'])
+termfiles = []
+pool = multiprocessing.Pool(processes=maxcores)
+with cache, BatchWriter(db, batchsize=dbbatchsize) as writer:
+    def ondone(name, result):
+        # the science frames go to the database as they are done:
+        if name[0] == 'reduce':
+            # a new reduced frame: its sources must be found again, and it
+            # goes into the stacks again.
+            writer.put([name[1]], {'reducedpath':reduced[name[1]],
+                                   'sources':None, 'stacked':0})
+        elif name[0] == 'align':
+            alignment, sources, engine = result
+            updates = {'alignment':alignment, 'stacked':0}
+            if sources is not None:
+                updates['sources'] = sources
+            if writealigned:
+                updates['alignedpath'] = aligned[name[1]]
+            writer.put([name[1]], updates)
+            engines[engine] += 1
+            cache.done(alignmentProduct(reduced[name[1]]))
+            if stackmode == 'streaming':
+                stacker.add(byrecno[name[1]]['filter'], reduced[name[1]], 
+                            alignment)
+            return
+        elif name[0] == 'terms':
+            # (the .npy files of the calibration terms, deleted below)
+            termfiles.extend(result)
+            return
+        # the other tasks return the path of what they made:
+        cache.done(result)
+    try:
+        tasks.run(pool, verbose=False, ondone=ondone)
+    finally:
+        # the calibration terms are only needed by the reductions of this
+        # run:
+        for path in termfiles:
+            Path(path).unlink(missing_ok=True)
+pool.close()
+recordCalibrations(db, calibsreduced, products)
+print(cache.report())
+print(f"aligned {engines['fft']} frames by cross correlation, "
+      f"{engines['astroalign']} with astroalign.")
+
+if stackmode == 'streaming':
+    for filter in stacker.accumulators:
+        writeStack(stackPath(outdir, target, filter), stacker.finish(filter))
+
+if stackmode == 'incremental':
+    images = db.select(['object', 'imagetyp'], [target, light],
+                       returnType='dict')
+    for filter in sorted(set(image['filter'] for image in images)):
+        relevant = [e for e in images
+                      if e['filter'] == filter and e['alignment'] is not None]
+        data = incrementalStack(db, target, filter, relevant, outdir, crop,
+                                stackrebuild, combiner, combinememory)
+        writeStack(stackPath(outdir, target, filter), data)
+
+################################### report ####################################
+wall = tasks.end - tasks.start
+print(f"\n{'stage':<10} {'tasks':>6} {'busy (s)':>9} {'from (s)':>9} "
+      f"{'to (s)':>8} {'workers':>8}")
+for stage, (n, busy, first, last, fraction) in tasks.utilisation(maxcores).items():
+    print(f"{stage:<10} {n:>6} {busy:>9.1f} {first:>9.1f} {last:>8.1f} "
+          f"{100*fraction:>7.0f}%")
+print(f"task graph: {wall:.1f} s on {maxcores} workers, "
+      f"total {time.time() - t0:.1f} s")